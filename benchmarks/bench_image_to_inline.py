@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+#   Micro-benchmark of the image_to_inline encode step.
+#   Compares the old path (save to a temp file, read it back, delete it)
+#   with the in-memory path used by tweet2html and mastodon2html.
+#   Run with `python benchmarks/bench_image_to_inline.py`
+
+#   For command line
+import argparse
+
+#   File and Bits
+import io
+import os
+import tempfile
+import timeit
+
+#   Image Manipulation
+from PIL import Image
+
+#   Etc
+import base64
+import random
+
+webp_settings = { "format": "webp", "optimize": True, "quality": 60 }
+
+def sample_images() :
+	#	Photo-ish JPEGs and flat PNGs in the sizes the scripts usually see
+	random.seed( 1 )
+	samples = {}
+	for ( width, height ) in ( (48, 48), (400, 400), (680, 383), (1200, 675) ) :
+		photo = Image.effect_noise( (width, height), 64 ).convert( "RGB" )
+		photo = Image.blend( photo, Image.linear_gradient( "L" ).resize( (width, height) ).convert( "RGB" ), 0.5 )
+		jpeg = io.BytesIO()
+		photo.save( jpeg, "jpeg", quality=85 )
+		samples[ f"photo-{width}x{height}.jpg" ] = jpeg.getvalue()
+
+		flat = Image.new( "RGBA", (width, height), (29, 155, 240, 255) )
+		flat.paste( (255, 255, 255, 255), ( width // 4, height // 4, width // 2, height // 2 ) )
+		png = io.BytesIO()
+		flat.save( png, "png" )
+		samples[ f"flat-{width}x{height}.png" ] = png.getvalue()
+	return samples
+
+def temp_file_path( content, url ) :
+	#	The original implementation
+	image_file = Image.open( io.BytesIO( content ) )
+	temp_file_name = "".join(x for x in url if x.isalnum())
+	output_img = os.path.join( tempfile.gettempdir() , f"{temp_file_name}.webp" )
+	image_file.save( output_img, 'webp', optimize=True, quality=60 )
+	binary_img      = open( output_img, 'rb' ).read()
+	base64_utf8_str = base64.b64encode( binary_img ).decode('utf-8')
+	os.remove( output_img )
+	return f'data:image/webp;base64,{base64_utf8_str}'
+
+def in_memory_path( content, url ) :
+	#	The current implementation
+	image_file = Image.open( io.BytesIO( content ) )
+	output_img = io.BytesIO()
+	image_file.save( output_img, **webp_settings )
+	base64_utf8_str = base64.b64encode( output_img.getvalue() ).decode('utf-8')
+	return f'data:image/webp;base64,{base64_utf8_str}'
+
+if __name__ == "__main__" :
+	arguments = argparse.ArgumentParser(
+		prog='bench_image_to_inline',
+		description='Compare temp file and in-memory image encoding')
+	arguments.add_argument("-n", "--number", type=int, default=20, help="Encodes per sample (default 20)", required=False)
+	args = arguments.parse_args()
+
+	samples = sample_images()
+	print( f"{'Sample':<22} {'Temp file':>12} {'In memory':>12} {'Speed up':>9}" )
+	total_old = 0.0
+	total_new = 0.0
+	for name, content in samples.items() :
+		url = f"https://pbs.twimg.com/media/{name}"
+		#	Both paths must produce the same output
+		assert temp_file_path( content, url ) == in_memory_path( content, url )
+		old = min( timeit.repeat( lambda: temp_file_path( content, url ), number=args.number, repeat=3 ) ) / args.number
+		new = min( timeit.repeat( lambda: in_memory_path( content, url ), number=args.number, repeat=3 ) ) / args.number
+		total_old += old
+		total_new += new
+		print( f"{name:<22} {old * 1000:>10.2f}ms {new * 1000:>10.2f}ms {old / new:>8.2f}x" )
+	print( f"{'Total':<22} {total_old * 1000:>10.2f}ms {total_new * 1000:>10.2f}ms {total_old / total_new:>8.2f}x" )
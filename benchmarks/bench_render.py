@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+#   Offline rendering benchmark.
+#   Renders the recorded Tweets and Mastodon posts in benchmarks/fixtures, without using the network,
+#   and times each stage - fetch, decode, encode, base64, template, and minify - and the whole render.
+#   The results are saved as JSON, so they can be compared between commits.
+#   Run with `python benchmarks/bench_render.py`, then `python benchmarks/bench_render.py --compare old.json`
+
+#   For command line
+import argparse
+
+#   File and Bits
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+
+#   Timing
+import statistics
+import time
+import tracemalloc
+
+#   Etc
+import base64
+from contextlib import redirect_stdout
+from fixture_store import FixtureStore
+
+repo_directory = os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) )
+
+#	Every render is cold - nothing is read from or written to the caches
+os.environ["TWEET2EMBED_CACHE"] = "0"
+sys.path.insert( 0, repo_directory )
+
+import requests
+from requests.adapters import BaseAdapter
+
+import http_client
+import embed_images
+from syndication import get_tweet, is_tombstone, get_ancestors
+from fetch_engine import tweet_image_urls, status_image_urls
+from tweet2html import tweet_options, tweet_to_html, tweet_html_output, render_tweet
+from mastodon2html import status_options, get_thread, mastodon_to_html, mastodon_html_output, render_status
+
+#	The examples from the README, and a Mastodon post of each type
+tweet_cases = {
+	"video":         "1432768058028875791",
+	"reply-image":   "1095659600420966400",
+	"multi-image":   "909106648928718848",
+	"quote":         "1560621791470448642",
+	"poll":          "670060095972245504",
+	"deleted":       "83659275024601088",
+	"summary-card":  "1131218926493413377",
+	"reply-quote":   "1485588404037648389",
+	"reply-chain":   "1500000000000000004",
+}
+mastodon_cases = {
+	"media":  "https://mastodon.social/@edent/110000000000000001",
+	"poll":   "https://mastodon.social/@edent/110000000000000002",
+	"card":   "https://mastodon.social/@edent/110000000000000003",
+	"thread": "https://mastodon.social/@edent/110000000000000010",
+}
+
+#	Rendered with the thread and CSS, as most people use it
+render_options = { "thread": True, "css": True }
+
+stages = [ "fetch", "decode", "encode", "base64", "template", "minify", "total" ]
+
+class FixtureAdapter( BaseAdapter ) :
+	#	Answers requests from the fixtures, as if they came from Twitter, Mastodon, and their image servers.
+	#	Anything which isn't in the fixtures is a 404.
+
+	def __init__( self ) :
+		super().__init__()
+		self.fixtures = FixtureStore()
+		self.missing  = set()
+
+	def send( self, request, **kwargs ) :
+		response = requests.Response()
+		response.request = request
+		response.url     = request.url
+		content = self.fixtures.get( request.url )
+		if content is None :
+			self.missing.add( request.url )
+			response.status_code = 404
+			response._content    = b""
+		else :
+			response.status_code = 200
+			response._content    = content
+		return response
+
+	def close( self ) :
+		pass
+
+def elapsed( start ) :
+	#	Milliseconds since start
+	return ( time.perf_counter() - start ) * 1000
+
+def measure_images( images, timings ) :
+	#	Download, decode, resize and encode, and base64 each ( URl, use ) one at a time, the same way embed_images does.
+	#	Returns ( URl, use ) -> encoded bytes
+	encoded_images = {}
+	for url, use in dict.fromkeys( images ) :
+		settings = embed_images.encode_settings( use )
+		start = time.perf_counter()
+		response = http_client.get( url )
+		response.raise_for_status()
+		timings["fetch"] += elapsed( start )
+
+		start = time.perf_counter()
+		image_file = embed_images.decode_image( response.content, settings["box"] )
+		timings["decode"] += elapsed( start )
+
+		start = time.perf_counter()
+		binary_img = embed_images.encode_to_budget( embed_images.fit_image( image_file, settings["box"] ), settings )
+		encoded_images[( url, use )] = binary_img
+		timings["encode"] += elapsed( start )
+
+		start = time.perf_counter()
+		f'data:image/{embed_images.image_type( binary_img )};base64,{base64.b64encode( binary_img ).decode("utf-8")}'
+		timings["base64"] += elapsed( start )
+	return encoded_images
+
+def measure_stages( fetch, image_urls, to_html, html_output, options ) :
+	#	Times each stage of one render. The template stage uses images which are already encoded,
+	#	so it only measures turning the data into HTML (including the data URls)
+	timings = { stage: 0.0 for stage in stages }
+	start = time.perf_counter()
+	data = fetch()
+	timings["fetch"] += elapsed( start )
+	if data is None :
+		return ( timings, None )
+
+	encoded_images = measure_images( image_urls( data ), timings )
+	embed_images.hold_images( encoded_images )
+	try :
+		start = time.perf_counter()
+		html = to_html( data, options )
+		timings["template"] = elapsed( start )
+	finally :
+		embed_images.release_images( list( encoded_images ) )
+
+	start = time.perf_counter()
+	html = html_output( html, options )
+	timings["minify"] = elapsed( start )
+	return ( timings, html )
+
+def measure_peak( fetch, to_html, options ) :
+	#	Peak memory allocated by Python while turning the data into HTML, downloading and encoding the images itself.
+	#	Memory used by the encoding processes isn't included
+	data = fetch()
+	if data is None :
+		return 0
+	tracemalloc.start()
+	try :
+		to_html( data, options )
+		return tracemalloc.get_traced_memory()[1] / 1024
+	finally :
+		tracemalloc.stop()
+
+def measure_total( fetch, render, options ) :
+	#	The whole render, as tweet2html and mastodon2html do it, with the images fetched concurrently
+	start = time.perf_counter()
+	data = fetch()
+	if data is not None :
+		render( data, options )
+	return elapsed( start )
+
+def run_case( number, fetch, image_urls, to_html, html_output, render, options ) :
+	#	Returns the median milliseconds of each stage over number runs, the peak memory, and the output size
+	runs = []
+	output_html = None
+	#	The first run is only to warm up imports and the worker pools
+	for run in range( number + 1 ) :
+		timings, output_html = measure_stages( fetch, image_urls, to_html, html_output, options )
+		timings["total"] = measure_total( fetch, render, options )
+		if run > 0 :
+			runs.append( timings )
+	result = { f"{stage}_ms": round( statistics.median( timings[stage] for timings in runs ), 3 ) for stage in stages }
+	result["peak_kb"]      = round( measure_peak( fetch, to_html, options ), 1 )
+	result["output_bytes"] = len( output_html.encode("utf-8") ) if output_html is not None else 0
+	return result
+
+def tweet_fetch( tweet_id, options ) :
+	def fetch() :
+		data = get_tweet( tweet_id )
+		#	A deleted Tweet is only fetched
+		if data is None or is_tombstone( data ) :
+			return None
+		#	Including the rest of the reply chain
+		return dict( data, ancestors=get_ancestors( data, options["depth"] ) )
+	return fetch
+
+def run_benchmarks( number ) :
+	results = {}
+	#	Reply chains are followed up to ten Tweets
+	tweet_render_options = tweet_options( dict( render_options, depth=10 ) )
+	for name, tweet_id in tweet_cases.items() :
+		results[f"tweet/{name}"] = run_case( number, tweet_fetch( tweet_id, tweet_render_options ),
+			lambda data: tweet_image_urls( data, True ), tweet_to_html, tweet_html_output, render_tweet, tweet_render_options )
+	#	Mastodon threads include the replies
+	status_render_options = status_options( dict( render_options, replies=True ) )
+	for name, mastodon_url in mastodon_cases.items() :
+		results[f"mastodon/{name}"] = run_case( number, lambda mastodon_url=mastodon_url: get_thread( mastodon_url, status_render_options ),
+			status_image_urls, mastodon_to_html, mastodon_html_output, render_status, status_render_options )
+	return results
+
+def git_commit() :
+	try :
+		result = subprocess.run( [ "git", "rev-parse", "--short", "HEAD" ], cwd=repo_directory, capture_output=True, text=True )
+		return result.stdout.strip() or None
+	except OSError :
+		return None
+
+def print_results( results ) :
+	print( f"{'Case':<20}" + "".join( f"{stage:>10}" for stage in stages ) + f"{'Peak KB':>10}{'Bytes':>10}" )
+	for name, result in results.items() :
+		print( f"{name:<20}" + "".join( f"{result[stage + '_ms']:>10.2f}" for stage in stages ) + f"{result['peak_kb']:>10.0f}{result['output_bytes']:>10}" )
+
+def compare_results( previous, results, threshold ) :
+	#	Prints the change in each stage. Returns True if any total is more than threshold percent slower
+	regressed = False
+	print( f"\nCompared with {previous.get('commit') or 'previous run'}" )
+	for name, result in results.items() :
+		if name not in previous["cases"] :
+			continue
+		changes = []
+		for stage in stages :
+			before = previous["cases"][name].get( f"{stage}_ms" )
+			after  = result[f"{stage}_ms"]
+			if not before :
+				continue
+			change = ( after - before ) / before * 100
+			changes.append( f"{stage} {change:+.0f}%" )
+			if stage == "total" and change > threshold :
+				regressed = True
+				changes.append( "SLOWER" )
+		print( f"{name:<20} {', '.join( changes )}" )
+	return regressed
+
+if __name__ == "__main__" :
+	arguments = argparse.ArgumentParser(
+		prog='bench_render',
+		description='Time each stage of rendering the recorded posts, without using the network')
+	arguments.add_argument("-n", "--number",  type=int,   default=5, help="Runs per post (default 5)", required=False)
+	arguments.add_argument("-o", "--output",  type=str,   default="bench_render.json", help="Where to save the results (default bench_render.json)", required=False)
+	arguments.add_argument("--compare",       type=str,   help="Results of an earlier run to compare with", required=False)
+	arguments.add_argument("--threshold",     type=float, default=10, help="Fail if a total is this many percent slower than --compare (default 10)", required=False)
+	args = arguments.parse_args()
+
+	#	Serve every request from the fixtures
+	adapter = FixtureAdapter()
+	session = http_client.get_session()
+	session.mount( "https://", adapter )
+	session.mount( "http://",  adapter )
+
+	#	The scripts' progress messages aren't needed
+	with redirect_stdout( io.StringIO() ) :
+		results = run_benchmarks( args.number )
+	if adapter.missing :
+		print( "Not in the fixtures: " + ", ".join( sorted( adapter.missing ) ) )
+
+	print_results( results )
+	output = {
+		"commit":   git_commit(),
+		"created":  time.strftime( "%Y-%m-%dT%H:%M:%SZ", time.gmtime() ),
+		"python":   platform.python_version(),
+		"platform": platform.platform(),
+		"number":   args.number,
+		"cases":    results,
+	}
+	with open( args.output, 'w', encoding="utf-8" ) as output_file :
+		json.dump( output, output_file, indent="\t" )
+	print( f"Saved to {args.output}" )
+
+	if args.compare :
+		with open( args.compare, 'r', encoding="utf-8" ) as previous_file :
+			previous = json.load( previous_file )
+		if compare_results( previous, results, args.threshold ) :
+			raise SystemExit( 1 )
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+#   Start-up benchmark for every entry point.
+#   Runs each one with `python -X importtime` on a path which exits early,
+#   and fails if the imports take longer than the budget,
+#   or if a slow module is imported before it is needed.
+#   Run with `python benchmarks/bench_startup.py`
+
+#   For command line
+import argparse
+
+#   File and Bits
+import os
+import subprocess
+import sys
+
+#   Etc
+import statistics
+
+repo_directory = os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) )
+
+#	Command line, and budget for imports in milliseconds (not counting Python's own start-up)
+entry_points = {
+	"tweet2html":    ( [ "tweet2html.py",    "--help" ], 60 ),
+	"mastodon2html": ( [ "mastodon2html.py", "--help" ], 60 ),
+	"tweet2json":    ( [ "tweet2json.py",    "not-a-tweet" ], 40 ),
+	"tweet2img":     ( [ "tweet2img.py",     "--help" ], 40 ),
+	"embed_server":  ( [ "embed_server.py",  "--help" ], 40 ),
+}
+
+#	These are only needed once there's work to do
+slow_modules = [ "requests", "PIL", "selenium", "webdriver_manager", "dateutil", "pyperclip", "asyncio" ]
+
+def import_times( command ) :
+	#	Returns ( milliseconds importing, set of modules imported )
+	result = subprocess.run(
+		[ sys.executable, "-X", "importtime" ] + command,
+		cwd=repo_directory, capture_output=True, text=True )
+	total   = 0
+	modules = set()
+	for line in result.stderr.splitlines() :
+		if not line.startswith( "import time:" ) or "cumulative" in line :
+			continue
+		_, cumulative, name = line.split( "|" )
+		module = name.strip()
+		modules.add( module )
+		#	Only count top level imports, and leave out Python's own start-up
+		if not name.startswith( "  " ) and module not in ( "site", "encodings", "_frozen_importlib_external" ) :
+			total += int( cumulative )
+	return ( total / 1000, modules )
+
+if __name__ == "__main__" :
+	arguments = argparse.ArgumentParser(
+		prog='bench_startup',
+		description='Check the start-up time of each entry point')
+	arguments.add_argument("-n", "--number", type=int,   default=5, help="Runs per entry point (default 5)", required=False)
+	arguments.add_argument("--scale",        type=float, default=1, help="Multiply the budgets, for slow machines (default 1)", required=False)
+	args = arguments.parse_args()
+
+	failed = False
+	print( f"{'Entry point':<15} {'Imports':>9} {'Budget':>8}  Slow modules imported" )
+	for name, ( command, budget ) in entry_points.items() :
+		runs = [ import_times( command ) for _ in range( args.number ) ]
+		median = statistics.median( milliseconds for milliseconds, _ in runs )
+		budget = budget * args.scale
+		slow = sorted( module for module in slow_modules if module in runs[0][1] )
+		status = "ok"
+		if median > budget or slow :
+			status = "FAIL"
+			failed = True
+		print( f"{name:<15} {median:>7.1f}ms {budget:>6.0f}ms  {', '.join( slow ) or '-'}  {status}" )
+
+	if failed :
+		raise SystemExit( 1 )
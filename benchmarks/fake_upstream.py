@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+#   Local stand-in for Twitter's syndication API, the Mastodon API, their image servers, and archive.org.
+#   Serves the recordings in benchmarks/fixtures, with configurable latency, errors, rate limits, and bandwidth.
+#   Run with `python benchmarks/fake_upstream.py --latency 0.2 --rate-limit 0.1`
+#   then point the scripts at it with `TWEET2EMBED_UPSTREAM=http://127.0.0.1:8900`
+
+#   For command line
+import argparse
+
+#   Server
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+#   Concurrency
+import signal
+import threading
+import time
+
+#   Etc
+import random
+from fixture_store import FixtureStore
+
+class Upstream :
+	#	What the fake server does, and what it has done
+
+	def __init__( self, latency=0, jitter=0, error_rate=0, rate_limit=0, retry_after=1, bandwidth=None ) :
+		self.fixtures    = FixtureStore()
+		self.latency     = latency		#	Seconds before every response
+		self.jitter      = jitter		#	Up to this many more seconds, at random
+		self.error_rate  = error_rate	#	Fraction of requests which get a 503
+		self.rate_limit  = rate_limit	#	Fraction of requests which get a 429
+		self.retry_after = retry_after	#	Seconds sent in Retry-After with a 429
+		self.bandwidth   = bandwidth	#	Bytes per second for each response, or None for no limit
+		self.lock     = threading.Lock()
+		self.counters = { "requests": 0, "200": 0, "404": 0, "429": 0, "503": 0, "archived": 0, "bytes": 0 }
+
+	def count( self, name, amount=1 ) :
+		with self.lock :
+			self.counters[name] += amount
+
+	def respond( self, method, url ) :
+		#	Returns ( status, headers, body ) for a request to the original URl
+		self.count( "requests" )
+		time.sleep( self.latency + random.uniform( 0, self.jitter ) )
+		roll = random.random()
+		if roll < self.rate_limit :
+			return ( 429, { "Retry-After": str( self.retry_after ) }, b"Rate limit exceeded" )
+		if roll < self.rate_limit + self.error_rate :
+			return ( 503, {}, b"Service Unavailable" )
+		if method == "POST" and url.startswith( "https://web.archive.org/save" ) :
+			self.count( "archived" )
+			return ( 200, { "Content-Type": "text/html" }, b"<html><title>Saving page</title></html>" )
+		body = self.fixtures.get( url )
+		if body is None :
+			return ( 404, {}, b"" )
+		if body.startswith( b"{" ) :
+			return ( 200, { "Content-Type": "application/json" }, body )
+		return ( 200, { "Content-Type": "application/octet-stream" }, body )
+
+	def summary( self ) :
+		with self.lock :
+			counters = dict( self.counters )
+		return ( f"{counters['requests']} requests - {counters['200']} OK, {counters['404']} not found, "
+			f"{counters['429']} rate limited, {counters['503']} errors, {counters['archived']} archived, {counters['bytes']:n} bytes sent" )
+
+def make_handler( upstream ) :
+
+	class UpstreamHandler( BaseHTTPRequestHandler ) :
+		protocol_version = "HTTP/1.1"
+
+		def original_url( self ) :
+			#	http_client sends the host it meant to reach
+			host = self.headers.get( "X-Forwarded-Host", self.headers.get( "Host", "" ) )
+			return f"https://{host}{self.path}"
+
+		def send_body( self, body ) :
+			if upstream.bandwidth is None :
+				self.wfile.write( body )
+				return
+			#	Send a twentieth of a second's worth at a time
+			chunk_size = max( 1, int( upstream.bandwidth / 20 ) )
+			for offset in range( 0, len( body ), chunk_size ) :
+				self.wfile.write( body[offset:offset + chunk_size] )
+				self.wfile.flush()
+				time.sleep( 0.05 )
+
+		def handle_request( self, method ) :
+			#	Read and ignore any request body, so the connection can be reused
+			length = int( self.headers.get( "Content-Length", 0 ) )
+			if length > 0 :
+				self.rfile.read( length )
+			status, headers, body = upstream.respond( method, self.original_url() )
+			upstream.count( str( status ) )
+			upstream.count( "bytes", len( body ) )
+			self.send_response( status )
+			for name, value in headers.items() :
+				self.send_header( name, value )
+			self.send_header( "Content-Length", str( len( body ) ) )
+			self.end_headers()
+			self.send_body( body )
+
+		def do_GET( self ) :
+			self.handle_request( "GET" )
+
+		def do_POST( self ) :
+			self.handle_request( "POST" )
+
+		def log_message( self, format, *args ) :
+			#	Too many requests to log each one
+			pass
+
+	return UpstreamHandler
+
+def main() :
+	#   Command line options
+	arguments = argparse.ArgumentParser(
+		prog='fake_upstream',
+		description='Serve the recorded fixtures as if they came from Twitter, Mastodon, and archive.org')
+	arguments.add_argument("--host",        type=str,   default="127.0.0.1", help="Address to listen on (default 127.0.0.1)", required=False)
+	arguments.add_argument("--port",        type=int,   default=8900,        help="Port to listen on (default 8900)", required=False)
+	arguments.add_argument("--latency",     type=float, default=0, help="Seconds before every response (default 0)", required=False)
+	arguments.add_argument("--jitter",      type=float, default=0, help="Up to this many extra seconds of latency, at random (default 0)", required=False)
+	arguments.add_argument("--error-rate",  type=float, default=0, help="Fraction of requests which get a 503 (default 0)", required=False)
+	arguments.add_argument("--rate-limit",  type=float, default=0, help="Fraction of requests which get a 429 (default 0)", required=False)
+	arguments.add_argument("--retry-after", type=int,   default=1, help="Seconds to ask rate limited clients to wait (default 1)", required=False)
+	arguments.add_argument("--bandwidth",   type=float, help="KB per second for each response (default unlimited)", required=False)
+	args = arguments.parse_args()
+
+	bandwidth = args.bandwidth * 1024 if args.bandwidth else None
+	upstream = Upstream( latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+		rate_limit=args.rate_limit, retry_after=args.retry_after, bandwidth=bandwidth )
+	server = ThreadingHTTPServer( ( args.host, args.port ), make_handler( upstream ) )
+	#	Stop cleanly when a load test kills it, as well as on Ctrl+C
+	def stop( signal_number, frame ) :
+		raise KeyboardInterrupt
+	signal.signal( signal.SIGTERM, stop )
+	print( f"Fake upstream on http://{args.host}:{args.port}/ - use TWEET2EMBED_UPSTREAM=http://{args.host}:{args.port}" )
+	try :
+		server.serve_forever()
+	except KeyboardInterrupt :
+		pass
+	finally :
+		server.server_close()
+		print( upstream.summary() )
+
+if __name__ == "__main__" :
+	main()
@@ -0,0 +1,62 @@
+#   Recorded responses in benchmarks/fixtures, looked up by the URl they came from.
+#   Shared by bench_render and fake_upstream.
+
+#   File and Bits
+import json
+import os
+import threading
+
+#   URl manipulation
+from urllib.parse import urlparse, parse_qs
+
+fixtures_directory = os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), "fixtures" )
+
+#	Returned for a Mastodon post with no recorded thread
+empty_context = b'{"ancestors": [], "descendants": []}'
+
+class FixtureStore :
+	#	tweets/{id}.json               - https://cdn.syndication.twimg.com/tweet-result?id={id}
+	#	mastodon/{id}.json             - https://{host}/api/v1/statuses/{id}
+	#	mastodon/{id}.context.json     - https://{host}/api/v1/statuses/{id}/context
+	#	images/                        - image URls, listed in images.json
+
+	def __init__( self, directory=fixtures_directory ) :
+		self.directory = directory
+		with open( os.path.join( directory, "images.json" ), 'r', encoding="utf-8" ) as images_file :
+			self.images = json.load( images_file )
+		#	Files are read once, so disk speed doesn't affect the timings
+		self.contents = {}
+		self.lock     = threading.Lock()
+
+	def path( self, url ) :
+		#	The fixture for a URl, or None
+		parts = urlparse( url )
+		if parts.path == "/tweet-result" and "id" in parse_qs( parts.query ) :
+			return os.path.join( self.directory, "tweets", parse_qs( parts.query )["id"][0] + ".json" )
+		if parts.path.startswith( "/api/v1/statuses/" ) :
+			status_path = parts.path.split("/")
+			if status_path[-1] == "context" :
+				return os.path.join( self.directory, "mastodon", status_path[-2] + ".context.json" )
+			return os.path.join( self.directory, "mastodon", status_path[-1] + ".json" )
+		if url in self.images :
+			return os.path.join( self.directory, "images", self.images[url] )
+		return None
+
+	def get( self, url ) :
+		#	The recorded body for a URl, or None if there isn't one
+		fixture_path = self.path( url )
+		if fixture_path is None :
+			return None
+		with self.lock :
+			if fixture_path in self.contents :
+				return self.contents[fixture_path]
+		try :
+			with open( fixture_path, 'rb' ) as fixture_file :
+				content = fixture_file.read()
+		except OSError :
+			if fixture_path.endswith( ".context.json" ) :
+				return empty_context
+			return None
+		with self.lock :
+			self.contents[fixture_path] = content
+		return content
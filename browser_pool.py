@@ -0,0 +1,179 @@
+#   Pool of warm headless browsers, reused across screenshots.
+#   Used by tweet2img.
+
+#   File and Bits
+import os
+
+#   Concurrency
+import queue
+import threading
+from contextlib import contextmanager
+
+def start_firefox() :
+	#   Selenium is slow to import, so only load it when a browser is needed
+	from selenium import webdriver
+	from selenium.webdriver.firefox.options import Options
+
+	#   Firefox's Headless Options
+	firefox_options = Options()
+	firefox_options.add_argument("--headless")
+	#   Start Firefox
+	return webdriver.Firefox( options=firefox_options )
+
+	# #   If using Chrome
+	# from selenium.webdriver.chrome.options import Options
+	# #   Chrome's Headless Options
+	# chrome_options = Options()
+	# chrome_options.add_argument('--headless=new')
+	# chrome_options.add_argument('--window-size=1920,2160')
+
+	# #   Turn off everything
+	# chrome_options.add_argument("--no-sandbox")
+	# chrome_options.add_argument("--disable-dev-shm-usage")
+	# chrome_options.add_argument("--disable-extensions")
+	# chrome_options.add_argument("--disable-infobars")
+	# chrome_options.add_argument("--disable-logging")
+	# chrome_options.add_argument("--log-level=3")
+	# chrome_options.add_argument('--force-device-scale-factor=1')
+	# chrome_options.add_argument('--high-dpi-support=1')
+
+	# #   Wayland to stop fuzzyness on fractional scaling
+	# chrome_options.add_argument("--enable-features=UseOzonePlatform")
+	# chrome_options.add_argument("--ozone-platform=wayland")
+
+	# #   Start Chrome
+	# return webdriver.Chrome(options=chrome_options)
+
+def process_tree_memory( pid ) :
+	#   Resident memory in MB of a process and all its children.
+	#   Returns None where /proc isn't available.
+	if not os.path.isdir( "/proc" ) :
+		return None
+	children = {}
+	for entry in os.listdir( "/proc" ) :
+		if not entry.isdecimal() :
+			continue
+		try :
+			with open( f"/proc/{entry}/stat", 'r' ) as stat_file :
+				#   The parent PID is the second field after the process name, which is in brackets
+				parent = int( stat_file.read().rsplit( ")", 1 )[1].split()[1] )
+			children.setdefault( parent, [] ).append( int( entry ) )
+		except ( OSError, ValueError, IndexError ) :
+			continue
+	total = 0
+	pending = [ pid ]
+	while pending :
+		current = pending.pop()
+		pending += children.get( current, [] )
+		try :
+			with open( f"/proc/{current}/status", 'r' ) as status_file :
+				for line in status_file :
+					if line.startswith( "VmRSS:" ) :
+						total += int( line.split()[1] )
+		except ( OSError, ValueError ) :
+			continue
+	return total / 1024
+
+class Browser :
+
+	def __init__( self, driver ) :
+		self.driver = driver
+		self.uses   = 0
+
+	def memory( self ) :
+		try :
+			return process_tree_memory( self.driver.service.process.pid )
+		except AttributeError :
+			return None
+
+	def responding( self ) :
+		#	A page can fail without the browser being broken
+		try :
+			self.driver.current_url
+			return True
+		except Exception :
+			return False
+
+	def quit( self ) :
+		try :
+			self.driver.quit()
+		except Exception :
+			pass
+
+class BrowserPool :
+	#	Up to size browsers are started when they are first needed.
+	#	A browser is replaced after max_uses screenshots, or when it uses more than max_memory MB.
+
+	def __init__( self, size=1, max_uses=50, max_memory=1024, start_browser=start_firefox ) :
+		self.size          = size
+		self.max_uses      = max_uses
+		self.max_memory    = max_memory
+		self.start_browser = start_browser
+		self.idle    = queue.Queue()
+		self.started = 0
+		self.lock    = threading.Lock()
+		self.all     = []
+
+	def acquire( self ) :
+		#	An idle browser, a new one if there's room, or wait for one to be released
+		try :
+			return self.idle.get_nowait()
+		except queue.Empty :
+			pass
+		with self.lock :
+			start = self.started < self.size
+			if start :
+				self.started += 1
+		if not start :
+			return self.idle.get()
+		print( "Starting browser…" )
+		try :
+			browser = Browser( self.start_browser() )
+		except BaseException :
+			with self.lock :
+				self.started -= 1
+			raise
+		with self.lock :
+			self.all.append( browser )
+		return browser
+
+	def release( self, browser, broken=False ) :
+		browser.uses += 1
+		recycle = broken or browser.uses >= self.max_uses
+		if not recycle and self.max_memory is not None :
+			memory = browser.memory()
+			if memory is not None and memory > self.max_memory :
+				print( f"Browser using {memory:.0f}MB, restarting…" )
+				recycle = True
+		if not recycle :
+			self.idle.put( browser )
+			return
+		#	Quit it, and let the next acquire start a fresh one
+		browser.quit()
+		with self.lock :
+			self.all.remove( browser )
+			self.started -= 1
+		#	Wake up anyone waiting so they can start a replacement
+		self.idle.put( None )
+
+	@contextmanager
+	def browser( self ) :
+		#	with pool.browser() as driver:
+		browser = self.acquire()
+		while browser is None :
+			#	A browser was recycled. Start a new one, or wait for one
+			browser = self.acquire()
+		try :
+			yield browser.driver
+		except Exception :
+			self.release( browser, broken=not browser.responding() )
+			raise
+		self.release( browser )
+
+	def close( self ) :
+		with self.lock :
+			browsers = list( self.all )
+			self.all = []
+			self.started = 0
+		for browser in browsers :
+			browser.quit()
@@ -0,0 +1,70 @@
+#   Mastodon's custom emoji - :shortcode: in posts and display names.
+#   Each text is substituted in one pass, and only the emoji which are used are downloaded.
+#   Used by mastodon2html and fetch_engine.
+
+#   Concurrency
+import threading
+
+#   Etc
+import re
+from embed_images import images_to_inline
+from image_assets import asset_store
+
+#	Shortcodes are letters, numbers, and underscores
+shortcode_pattern = re.compile( r":([a-zA-Z0-9_]{2,}):" )
+
+#	Encoded emoji for each server, so a batch from one server only encodes each :shortcode: once.
+#	( Host, assets URl ) -> { shortcode: ( image URl, <img> HTML ) }
+#	Emoji linked from an assets directory are kept apart from inlined ones
+emoji_cache      = {}
+emoji_cache_lock = threading.Lock()
+max_host_emoji   = 2048	#	A server's emoji are forgotten if it has more than this
+
+def used_emojis( texts, emojis ) :
+	#	The emoji which appear in any of the texts.
+	#	Returns shortcode -> image URl, in the order they are first used
+	available = { emoji["shortcode"]: emoji["url"] for emoji in emojis or [] }
+	used = {}
+	for text in texts :
+		for shortcode in shortcode_pattern.findall( text or "" ) :
+			if shortcode in available :
+				used[shortcode] = available[shortcode]
+	return used
+
+def cached_emoji( host, shortcode, url ) :
+	#	The <img> HTML, if this server's :shortcode: has already been encoded from the same URl
+	with emoji_cache_lock :
+		cached = emoji_cache.get( ( host, asset_store.url ), {} ).get( shortcode )
+	if cached is not None and cached[0] == url :
+		return cached[1]
+	return None
+
+def uncached_urls( host, used ) :
+	#	Image URls of the used emoji which still need encoding
+	return [ url for shortcode, url in used.items() if cached_emoji( host, shortcode, url ) is None ]
+
+def emojis_to_html( host, used ) :
+	#	Returns shortcode -> <img> HTML, encoding any which aren't cached
+	emoji_html = {}
+	missing    = []
+	for shortcode, url in used.items() :
+		html = cached_emoji( host, shortcode, url )
+		if html is None :
+			missing.append( shortcode )
+		else :
+			emoji_html[shortcode] = html
+	if missing :
+		print( f"Embedding {len(missing)} emoji…" )
+		emoji_imgs = images_to_inline( [ used[shortcode] for shortcode in missing ], "emoji" )
+		with emoji_cache_lock :
+			host_emoji = emoji_cache.setdefault( ( host, asset_store.url ), {} )
+			if len( host_emoji ) + len( missing ) > max_host_emoji :
+				host_emoji.clear()
+			for shortcode, emoji_img in zip( missing, emoji_imgs ) :
+				emoji_html[shortcode] = f'<img src="{emoji_img}" alt=":{shortcode}:" class="social-embed-emoji">'
+				host_emoji[shortcode] = ( used[shortcode], emoji_html[shortcode] )
+	return emoji_html
+
+def replace_emojis( text, emoji_html ) :
+	#	One pass over the text. Unknown shortcodes are left as they are
+	return shortcode_pattern.sub( lambda match: emoji_html.get( match.group(1), match.group(0) ), text )
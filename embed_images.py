@@ -0,0 +1,261 @@
+#   Downloading and encoding of inlined images.
+#   Shared by tweet2html and mastodon2html.
+
+#   File and Bits
+import io
+import os
+
+#   Concurrency
+import threading
+import time
+
+#   Image Manipulation
+#   PIL and the worker pools are loaded when they are first used
+from image_cache import image_cache
+from image_assets import asset_store
+
+#   Etc
+import http_client
+import metrics
+import timing
+import base64
+from singleflight import SingleFlight
+
+#	Encode settings for inlined images. Also part of the cache key
+webp_settings = { "format": "webp", "optimize": True, "quality": 60 }
+
+#	Each kind of image is shrunk to fit the box it is shown in, before it is encoded.
+#	Avatars, badges, and emoji are twice their CSS size, so they are sharp on high density screens.
+#	Media and card thumbnails are the embed's full width.
+#	An image bigger than its budget in bytes is encoded at a lower quality until it fits.
+#	Badges and emoji are often flat colours, so they are also tried as lossless
+image_uses = {
+	"avatar": { "box": ( 96, 96 ),    "budget": 4 * 1024 },
+	"badge":  { "box": ( 32, 32 ),    "budget": 2 * 1024, "lossless": True },
+	"emoji":  { "box": ( 32, 32 ),    "budget": 2 * 1024, "lossless": True },
+	"media":  { "box": ( 550, 1100 ), "budget": 48 * 1024 },
+	"card":   { "box": ( 550, 1100 ), "budget": 32 * 1024 },
+}
+budget_qualities = ( 60, 50, 40, 30 )	#	Tried in order, until the image fits
+
+#	AVIF is often smaller than WebP, but slower to encode.
+#	It needs Pillow 11.3 or later, or pillow-avif-plugin
+avif_enabled = os.environ.get( "TWEET2EMBED_AVIF", "0" ) == "1"
+avif_support = None
+
+#	Encoding is the main CPU cost, so it runs on one process per core.
+#	Downloads run on threads which hand their images to the processes.
+encode_workers   = os.cpu_count() or 1
+encode_pool      = None
+download_pool    = None
+pool_lock        = threading.Lock()
+
+#	Images which have already been downloaded and encoded for the posts being rendered.
+#	( URl, use ) -> [ encoded bytes, number of renders holding it, src or None until it is first inlined ]
+#	An avatar or badge used by the parent, quote, and reply is only base64 encoded once.
+prefetched    = {}
+prefetch_lock = threading.Lock()
+
+#	Concurrent renders asking for the same image share one download and encode.
+#	Downloads are shared by URl, so an image used twice - e.g. as a card and as media - is downloaded once
+download_flights = SingleFlight()
+image_flights    = SingleFlight()
+
+def hold_images( encoded_images ) :
+	#	Keep encoded images in memory until the renders using them are released
+	with prefetch_lock :
+		for image, binary_img in encoded_images.items() :
+			if image in prefetched :
+				prefetched[image][1] += 1
+			else :
+				prefetched[image] = [ binary_img, 1, None ]
+
+def release_images( images ) :
+	with prefetch_lock :
+		for image in images :
+			if image in prefetched :
+				if prefetched[image][1] <= 1 :
+					del prefetched[image]
+				else :
+					prefetched[image][1] -= 1
+
+def held_image( url, use ) :
+	#	The encoded bytes, if a render is holding this image
+	with prefetch_lock :
+		return prefetched[( url, use )][0] if ( url, use ) in prefetched else None
+
+def check_avif() :
+	#	Can this Pillow write AVIF?
+	global avif_support
+	if avif_support is None :
+		from PIL import Image
+		try :
+			#	Older versions of Pillow need the plugin, which registers itself
+			import pillow_avif
+		except ImportError :
+			pass
+		Image.init()
+		avif_support = "AVIF" in Image.SAVE
+	return avif_support
+
+def encode_settings( use ) :
+	#	Everything which decides how an image is encoded. Also part of the cache key
+	settings = dict( webp_settings, use=use, qualities=budget_qualities, **image_uses[use] )
+	settings["avif"] = avif_enabled and check_avif()
+	return settings
+
+def image_type( binary_img ) :
+	#	AVIF, if it was the smallest, or WebP
+	if binary_img[4:12] in ( b"ftypavif", b"ftypavis" ) :
+		return "avif"
+	return "webp"
+
+def decode_image( content, box ) :
+	from PIL import Image
+	image_file = Image.open( io.BytesIO( content ) )
+	#	JPEGs can be decoded at a half, quarter, or eighth of their size, which is much quicker
+	image_file.draft( image_file.mode, tuple( box ) )
+	image_file.load()
+	return image_file
+
+def fit_image( image_file, box ) :
+	#	Shrink to fit the box, keeping the aspect ratio. Images are never enlarged
+	from PIL import Image
+	#	Palette images can only be resized roughly
+	if image_file.mode not in ( "RGB", "RGBA" ) :
+		image_file = image_file.convert( "RGBA" if image_file.has_transparency_data else "RGB" )
+	image_file.thumbnail( tuple( box ), Image.LANCZOS )
+	return image_file
+
+def save_image( image_file, **options ) :
+	output_img = io.BytesIO()
+	image_file.save( output_img, **options )
+	return output_img.getvalue()
+
+def encode_to_budget( image_file, settings ) :
+	#	The smallest candidate at the highest quality which fits the budget.
+	#	If none fit, the smallest at the lowest quality
+	for attempt, quality in enumerate( settings["qualities"] ) :
+		candidates = [ save_image( image_file, **dict( webp_settings, quality=quality ) ) ]
+		if settings["avif"] :
+			candidates.append( save_image( image_file, format="avif", quality=quality ) )
+		if settings.get( "lossless" ) and attempt == 0 :
+			candidates.append( save_image( image_file, **dict( webp_settings, lossless=True ) ) )
+		binary_img = min( candidates, key=len )
+		if len( binary_img ) <= settings["budget"] :
+			break
+	return binary_img
+
+def encode_image_timed( content, settings ) :
+	#	Runs in a worker process, so it returns its own timings.
+	#	Returns ( encoded bytes, seconds decoding, seconds resizing and encoding )
+	start = time.perf_counter()
+	image_file = decode_image( content, settings["box"] )
+	decoded = time.perf_counter()
+	binary_img = encode_to_budget( fit_image( image_file, settings["box"] ), settings )
+	return ( binary_img, decoded - start, time.perf_counter() - decoded )
+
+def record_encode( encoded ) :
+	#	Record the worker's timings, and return the encoded bytes
+	binary_img, decode_seconds, encode_seconds = encoded
+	metrics.encode_seconds.observe( decode_seconds + encode_seconds )
+	timing.record( "image.decode", decode_seconds )
+	timing.record( "image.encode", encode_seconds )
+	return binary_img
+
+def get_encode_pool() :
+	global encode_pool
+	with pool_lock :
+		if encode_pool is None :
+			import multiprocessing
+			from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+			#	The pool is first used from worker threads, which may be holding locks,
+			#	so workers start from a fresh forkserver or spawned interpreter rather than a fork.
+			#	With those, workers are only started as the queue needs them, so a run with one avatar starts one.
+			if "forkserver" in multiprocessing.get_all_start_methods() :
+				context = multiprocessing.get_context( "forkserver" )
+				context.set_forkserver_preload( [ "embed_images", "PIL.Image" ] )
+			else :
+				context = multiprocessing.get_context( "spawn" )
+			try :
+				encode_pool = ProcessPoolExecutor( max_workers=encode_workers, mp_context=context )
+			except ( ImportError, OSError, NotImplementedError ) :
+				#	Where processes aren't available, encode on threads instead
+				encode_pool = ThreadPoolExecutor( max_workers=encode_workers )
+	return encode_pool
+
+def encode_on_threads( broken_pool ) :
+	#	Replace a process pool whose workers couldn't start, e.g. when __main__ can't be imported again
+	global encode_pool
+	from concurrent.futures import ThreadPoolExecutor
+	with pool_lock :
+		if encode_pool is broken_pool :
+			print( "Encoding images on threads…" )
+			encode_pool = ThreadPoolExecutor( max_workers=encode_workers )
+	broken_pool.shutdown( wait=False )
+	return encode_pool
+
+def get_download_pool() :
+	global download_pool
+	with pool_lock :
+		if download_pool is None :
+			from concurrent.futures import ThreadPoolExecutor
+			download_pool = ThreadPoolExecutor( max_workers=encode_workers * 2 )
+	return download_pool
+
+def download_image( url ) :
+	with timing.span( "image.download" ) :
+		image_file = http_client.get( url )
+		image_file.raise_for_status()
+	return image_file.content
+
+def encode_image( url, settings ) :
+	#	Download the image, or wait for the download which is already in flight
+	content = download_flights.do( url, lambda: download_image( url ) )
+	#	Encode it on a worker process
+	from concurrent.futures.process import BrokenProcessPool
+	pool = get_encode_pool()
+	try :
+		encoded = pool.submit( encode_image_timed, content, settings ).result()
+	except BrokenProcessPool :
+		encoded = encode_on_threads( pool ).submit( encode_image_timed, content, settings ).result()
+	return record_encode( encoded )
+
+def fetch_encoded( url, use ) :
+	#	Encoded images are cached on disk between runs.
+	#	If another thread is already encoding this URl for the same use, wait for its result instead
+	settings = encode_settings( use )
+	return image_flights.do( ( url, use ), lambda: image_cache.fetch( url, settings, lambda: encode_image( url, settings ) ) )
+
+def image_to_inline( url, use="media" ) :
+	#	Returns the src for an <img> - a data URl, or the URl of a file in the assets directory.
+	#	use is a key of image_uses
+	with prefetch_lock :
+		held = prefetched.get( ( url, use ) )
+		binary_img, image_src = ( held[0], held[2] ) if held is not None else ( None, None )
+	if image_src is not None :
+		if not asset_store.enabled :
+			timing.add_inlined( len( image_src ) )
+		return image_src
+	if binary_img is None :
+		binary_img = fetch_encoded( url, use )
+	if asset_store.enabled :
+		with timing.span( "image.asset" ) :
+			image_src = asset_store.save( binary_img, image_type( binary_img ) )
+	else :
+		#   Convert image to base64 data URl
+		with timing.span( "image.base64" ) :
+			base64_utf8_str = base64.b64encode( binary_img ).decode('utf-8')
+			#	Return as data encoded suitable for an <img src="...">
+			image_src = f'data:image/{image_type( binary_img )};base64,{base64_utf8_str}'
+			timing.add_inlined( len( image_src ) )
+	#	Remember it for the rest of the render
+	with prefetch_lock :
+		if ( url, use ) in prefetched :
+			prefetched[( url, use )][2] = image_src
+	return image_src
+
+def images_to_inline( urls, use="media" ) :
+	#	Download and encode several images at once.
+	#	Results are in the same order as the URls.
+	return list( get_download_pool().map( lambda url: image_to_inline( url, use ), urls ) )
@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+#   Serves embeds over HTTP.
+#   GET /tweet/<id>?thread=1&depth=5&schema=1&css=1&pretty=1
+#   GET /mastodon?url=https://example.social/@user/123&thread=1&replies=1&depth=10&fan_out=5
+#   The HTTP connections, image cache, and rendered embeds stay warm between requests.
+
+#   For command line
+import argparse
+
+#   Server
+from urllib.parse import urlparse, parse_qs
+
+#   Concurrency
+import threading
+import time
+from collections import OrderedDict
+
+#   Etc
+import hashlib
+import html
+
+#	Formatting
+import locale
+
+#   Rendering
+from singleflight import SingleFlight
+from image_assets import asset_store
+import metrics
+
+#   Slow imports (http.server and the renderers) are in the functions which use them, so --help is quick
+
+#	Rendered embeds served from memory, or rendered for the request
+fragment_requests = metrics.Counter( "tweet2embed_fragment_cache_requests_total", "embed_server requests by whether the embed was already rendered", [ "result" ] )
+
+#	Option names accepted in the query string
+option_names = ( "thread", "css", "pretty", "schema", "replies" )
+#	Numeric options. Only set when given, as tweet2html and mastodon2html have different defaults
+number_option_names = ( "depth", "fan_out" )
+
+class EmbedNotFound( Exception ) :
+	pass
+
+class EmbedUnavailable( Exception ) :
+	pass
+
+class FragmentCache :
+	#	Rendered embeds, with the time they were rendered and their ETag.
+	#	Keeps the most recently used max_entries for ttl seconds.
+
+	def __init__( self, max_entries, ttl ) :
+		self.max_entries = max_entries
+		self.ttl     = ttl
+		self.entries = OrderedDict()	#	Key -> ( rendered, etag, html )
+		self.lock    = threading.Lock()
+
+	def get( self, key ) :
+		with self.lock :
+			entry = self.entries.get( key )
+			if entry is None :
+				return None
+			if time.time() - entry[0] > self.ttl :
+				del self.entries[key]
+				return None
+			self.entries.move_to_end( key )
+			return entry
+
+	def put( self, key, embed_html ) :
+		entry = ( time.time(), make_etag( embed_html ), embed_html )
+		with self.lock :
+			self.entries[key] = entry
+			self.entries.move_to_end( key )
+			while len( self.entries ) > self.max_entries :
+				self.entries.popitem( last=False )
+		return entry
+
+def make_etag( embed_html ) :
+	#	Strong ETag - changes whenever a single byte of the embed changes
+	return '"' + hashlib.sha256( embed_html.encode("utf-8") ).hexdigest() + '"'
+
+def query_options( query ) :
+	options = {}
+	for name in option_names :
+		value = query.get( name, [ "0" ] )[-1].lower()
+		options[name] = value in ( "1", "true", "yes", "on" )
+	for name in number_option_names :
+		if name in query :
+			value = query[name][-1]
+			if not value.isdecimal() :
+				raise ValueError( f"{name} must be a whole number" )
+			options[name] = int( value )
+	return options
+
+class EmbedService :
+	#	Renders embeds, coalescing requests for the same post into one upstream fetch
+
+	def __init__( self, max_entries=1000, ttl=300 ) :
+		self.fragments = FragmentCache( max_entries, ttl )
+		self.fetches   = SingleFlight()	#	One upstream fetch per post at a time
+		self.renders   = SingleFlight()	#	One render per post and options at a time
+
+	def embed( self, key, fetch, render ) :
+		#	Returns ( etag, html ) from the cache, or fetches and renders it
+		entry = self.fragments.get( key )
+		fragment_requests.inc( result="hit" if entry is not None else "miss" )
+		if entry is None :
+			entry = self.renders.do( key, lambda: self.fragments.put( key, render( self.fetches.do( key[:2], fetch ) ) ) )
+		return ( entry[1], entry[2] )
+
+	def tweet( self, tweet_id, options ) :
+		from tweet2html import render_tweet
+		from syndication import get_tweet, is_tombstone
+
+		def fetch() :
+			data = get_tweet( tweet_id )
+			if data is None :
+				raise EmbedUnavailable( f"Couldn't download {tweet_id}" )
+			if is_tombstone( data ) :
+				metrics.tombstones.inc()
+				raise EmbedNotFound( f"{tweet_id} was deleted by the Post author." )
+			return data
+		key = ( "tweet", tweet_id, tuple( sorted( options.items() ) ) )
+		return self.embed( key, fetch, lambda data: render_tweet( data, options ) )
+
+	def mastodon( self, mastodon_url, options ) :
+		from mastodon2html import render_status, get_status
+
+		def fetch() :
+			data = get_status( mastodon_url )
+			if data is None :
+				raise EmbedUnavailable( f"Couldn't download {mastodon_url}" )
+			if "error" in data :
+				raise EmbedNotFound( f"{mastodon_url} doesn't exist." )
+			return data
+		key = ( "mastodon", mastodon_url, tuple( sorted( options.items() ) ) )
+		return self.embed( key, fetch, lambda data: render_status( data, options ) )
+
+def make_handler( service ) :
+	from http.server import BaseHTTPRequestHandler
+
+	class EmbedHandler( BaseHTTPRequestHandler ) :
+		protocol_version = "HTTP/1.1"
+
+		def send_text( self, status, text ) :
+			body = html.escape( text ).encode("utf-8")
+			self.send_response( status )
+			self.send_header( "Content-Type", "text/plain; charset=utf-8" )
+			self.send_header( "Content-Length", str( len( body ) ) )
+			self.end_headers()
+			self.wfile.write( body )
+
+		def send_embed( self, etag, embed_html ) :
+			#	Clients can revalidate with If-None-Match
+			if etag in [ tag.strip() for tag in self.headers.get( "If-None-Match", "" ).split(",") ] :
+				self.send_response( 304 )
+				self.send_header( "ETag", etag )
+				self.send_header( "Content-Length", "0" )
+				self.end_headers()
+				return
+			body = embed_html.encode("utf-8")
+			self.send_response( 200 )
+			self.send_header( "Content-Type", "text/html; charset=utf-8" )
+			self.send_header( "Content-Length", str( len( body ) ) )
+			self.send_header( "ETag", etag )
+			self.send_header( "Cache-Control", "no-cache" )
+			self.end_headers()
+			self.wfile.write( body )
+
+		def send_metrics( self ) :
+			#	The server has no end of a run to report
+			body = metrics.render( exclude=( metrics.last_run, ) ).encode("utf-8")
+			self.send_response( 200 )
+			self.send_header( "Content-Type", "text/plain; version=0.0.4; charset=utf-8" )
+			self.send_header( "Content-Length", str( len( body ) ) )
+			self.end_headers()
+			self.wfile.write( body )
+
+		def do_GET( self ) :
+			request = urlparse( self.path )
+			query   = parse_qs( request.query )
+			path    = request.path.rstrip("/").split("/")
+			if request.path == "/metrics" :
+				self.send_metrics()
+				return
+			try :
+				options = query_options( query )
+			except ValueError as error :
+				self.send_text( 400, str( error ) )
+				return
+			try :
+				if len( path ) == 3 and path[1] == "tweet" and path[2].isdecimal() :
+					etag, embed_html = service.tweet( path[2], options )
+				elif request.path == "/mastodon" and "url" in query :
+					etag, embed_html = service.mastodon( query["url"][-1], options )
+				else :
+					self.send_text( 404, "Use /tweet/<id> or /mastodon?url=<url>" )
+					return
+			except EmbedNotFound as error :
+				self.send_text( 404, str( error ) )
+				return
+			except EmbedUnavailable as error :
+				self.send_text( 502, str( error ) )
+				return
+			except Exception as error :
+				self.send_text( 500, f"Couldn't render the embed - {error}" )
+				return
+			self.send_embed( etag, embed_html )
+
+	return EmbedHandler
+
+def main() :
+	#   Command line options
+	arguments = argparse.ArgumentParser(
+		prog='embed_server',
+		description='Serve Tweet and Mastodon embeds over HTTP')
+	arguments.add_argument("--host",    type=str, default="127.0.0.1", help="Address to listen on (default 127.0.0.1)", required=False)
+	arguments.add_argument("--port",    type=int, default=8000,        help="Port to listen on (default 8000)",         required=False)
+	arguments.add_argument("--ttl",     type=int, default=300,         help="Seconds to keep a rendered embed (default 300)", required=False)
+	arguments.add_argument("--entries", type=int, default=1000,        help="Number of rendered embeds to keep (default 1000)", required=False)
+	args = arguments.parse_args()
+
+	#	Number formatting follows the user's locale
+	locale.setlocale(locale.LC_ALL, '')
+
+	#	Images are always inlined, as there is nothing serving an assets directory
+	asset_store.configure( None )
+
+	from http.server import ThreadingHTTPServer
+	service = EmbedService( max_entries=args.entries, ttl=args.ttl )
+	server  = ThreadingHTTPServer( ( args.host, args.port ), make_handler( service ) )
+	print( f"Serving embeds on http://{args.host}:{args.port}/" )
+	try :
+		server.serve_forever()
+	except KeyboardInterrupt :
+		pass
+	finally :
+		server.server_close()
+
+if __name__ == "__main__" :
+	main()
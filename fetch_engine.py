@@ -0,0 +1,108 @@
+#   Fetches every image a post needs at once, before it is rendered.
+#   Used by tweet2html and mastodon2html.
+
+#   Concurrency
+#   asyncio is imported when it is first used, as it is slow to import
+
+#   URl manipulation
+from urllib.parse import urlparse
+
+#   Etc
+import timing
+from image_cache import image_cache
+import embed_images
+from custom_emoji import used_emojis, uncached_urls
+from syndication import tweet_ancestors
+
+def tweet_image_urls( tweet_data, thread_show ) :
+	#	Every image tweet_to_html will inline, including the parents and quote.
+	#	Each is ( URl, use ), as the same picture is encoded differently as an avatar or as media
+	urls = []
+	if thread_show :
+		for ancestor in tweet_ancestors( tweet_data ) :
+			urls += tweet_image_urls( ancestor, thread_show )
+		if "quoted_tweet" in tweet_data :
+			urls += tweet_image_urls( tweet_data["quoted_tweet"], thread_show )
+	if "highlighted_label" in tweet_data["user"] :
+		urls.append( ( tweet_data["user"]["highlighted_label"]["badge"]["url"], "badge" ) )
+	for media in tweet_data.get( "mediaDetails", [] ) :
+		urls.append( ( media["media_url_https"] + ":small", "media" ) )
+	if "card" in tweet_data :
+		card_data = tweet_data["card"]
+		if "summary_large_image" == card_data["name"] and "thumbnail_image" in card_data["binding_values"] :
+			urls.append( ( card_data["binding_values"]["thumbnail_image"]["image_value"]["url"], "card" ) )
+	urls.append( ( tweet_data["user"]["profile_image_url_https"], "avatar" ) )
+	return urls
+
+def status_image_urls( mastodon_data ) :
+	#	Every image mastodon_to_html will inline, as ( URl, use ).
+	#	Only emoji which are used, and haven't been encoded for this server already
+	host = urlparse( mastodon_data["url"] ).netloc
+	emoji_urls  = uncached_urls( host, used_emojis( [ mastodon_data["content"] ], mastodon_data.get( "emojis" ) ) )
+	emoji_urls += uncached_urls( host, used_emojis( [ mastodon_data["account"]["display_name"] ], mastodon_data["account"].get( "emojis" ) ) )
+	urls = [ ( url, "emoji" ) for url in emoji_urls ]
+	for media in mastodon_data.get( "media_attachments" ) or [] :
+		urls.append( ( media["preview_url"], "media" ) )
+	card_data = mastodon_data.get( "card" )
+	if card_data is not None and card_data.get( "image" ) is not None :
+		urls.append( ( card_data["image"], "card" ) )
+	urls.append( ( mastodon_data["account"]["avatar"], "avatar" ) )
+	#	And the thread, if it has been added
+	for status in ( mastodon_data.get( "ancestors" ) or [] ) + ( mastodon_data.get( "replies" ) or [] ) :
+		urls += status_image_urls( status )
+	return urls
+
+async def fetch_image( image ) :
+	#	Returns the encoded image - from another render, the cache, or downloaded
+	import asyncio
+	url, use = image
+	binary_img = embed_images.held_image( url, use )
+	if binary_img is not None :
+		return binary_img
+	with timing.span( "image.cache" ) :
+		cached = await asyncio.to_thread( image_cache.get, url, embed_images.encode_settings( use ) )
+	if cached is not None :
+		image_cache.record_hit( cached )
+		return cached
+	#	Each image is encoded as soon as it arrives, while the others are still downloading.
+	#	Concurrent renders fetching the same URl share the work.
+	#	http_client limits the downloads from each host, across every render
+	return await asyncio.to_thread( embed_images.fetch_encoded, url, use )
+
+async def fetch_images( images ) :
+	#	Fetch all the ( URl, use ) concurrently. Returns ( URl, use ) -> encoded image for the ones which worked
+	import asyncio
+	results = await asyncio.gather( *[ fetch_image( image ) for image in images ], return_exceptions=True )
+	encoded_images = {}
+	for image, result in zip( images, results ) :
+		if isinstance( result, Exception ) :
+			#	The render will try this one again
+			print( f"Prefetch failed {image[0]} - {result}" )
+		else :
+			encoded_images[image] = result
+	return encoded_images
+
+def run_coroutine( coroutine ) :
+	#	asyncio.run, which also works when called from code already running an event loop
+	import asyncio
+	try :
+		asyncio.get_running_loop()
+	except RuntimeError :
+		return asyncio.run( coroutine )
+	#	Loops can't be nested, so run it on a new loop in another thread
+	from concurrent.futures import ThreadPoolExecutor
+	with ThreadPoolExecutor( max_workers=1 ) as loop_thread :
+		return loop_thread.submit( asyncio.run, coroutine ).result()
+
+def prefetch_images( images ) :
+	#	Fetch and encode everything at once, and hold it until release_images( images )
+	#	Returns the ( URl, use ) which are being held
+	images = list( dict.fromkeys( images ) )
+	print( f"Fetching {len(images)} images…" )
+	with timing.span( "images.prefetch" ) :
+		encoded_images = run_coroutine( fetch_images( images ) )
+	embed_images.hold_images( encoded_images )
+	return list( encoded_images )
+
+def release_images( images ) :
+	embed_images.release_images( images )
@@ -0,0 +1,161 @@
+#   Shared HTTP client used by all the scripts.
+#   Keeps connections to each host open between requests, sets timeouts,
+#   and retries with exponential backoff when a request can be retried.
+
+#   File and Bits
+import os
+
+#   Concurrency
+import threading
+import time
+
+#   URl manipulation
+from urllib.parse import urlsplit
+
+#   Etc
+#   requests is imported when it is first used, as it is slow to import
+import random
+import metrics
+import timing
+
+#   Defaults can be changed with environment variables
+connect_timeout = float( os.environ.get( "TWEET2EMBED_CONNECT_TIMEOUT", 5 ) )
+read_timeout    = float( os.environ.get( "TWEET2EMBED_READ_TIMEOUT",    30 ) )
+max_retries     = int( os.environ.get( "TWEET2EMBED_RETRIES", 4 ) )
+#	Send every request to this server instead, such as benchmarks/fake_upstream.py
+upstream        = os.environ.get( "TWEET2EMBED_UPSTREAM", "" ).rstrip("/")
+backoff_base    = 0.5	#	Seconds before the first retry, doubled after each one
+backoff_max     = 30	#	Longest wait between retries
+
+#	Only these are worth trying again
+retry_statuses   = { 408, 425, 429, 500, 502, 503, 504 }
+
+#	Enough connections per host for every download thread
+pool_size = max( 16, ( os.cpu_count() or 1 ) * 2 )
+#	Most requests in flight to any one host at a time, across every thread and render.
+#	Kept under pool_size, so each connection is put back in the pool and reused
+per_host_limit = min( 6, pool_size )
+
+session      = None
+session_lock = threading.Lock()
+
+#	Host -> semaphore limiting the requests to it
+host_limits      = {}
+host_limits_lock = threading.Lock()
+
+#	Counters
+counter_lock = threading.Lock()
+counters     = { "requests": 0, "retries": 0 }
+
+def get_session() :
+	global session
+	with session_lock :
+		if session is None :
+			import requests
+			from requests.adapters import HTTPAdapter
+			session = requests.Session()
+			adapter = HTTPAdapter( pool_connections=pool_size, pool_maxsize=pool_size )
+			session.mount( "https://", adapter )
+			session.mount( "http://",  adapter )
+	return session
+
+def host_limit( host ) :
+	with host_limits_lock :
+		if host not in host_limits :
+			host_limits[host] = threading.BoundedSemaphore( per_host_limit )
+		return host_limits[host]
+
+def backoff( attempt ) :
+	#	Exponential backoff with full jitter
+	return random.uniform( 0, min( backoff_max, backoff_base * ( 2 ** attempt ) ) )
+
+def retry_after( response ) :
+	#	Seconds the server asked us to wait, if it said
+	try :
+		return min( backoff_max, float( response.headers.get( "Retry-After", "" ) ) )
+	except ValueError :
+		return None
+
+def upstream_request( url, kwargs ) :
+	#	Rewrites the URl to go to the upstream server, which is told the original host
+	parts = urlsplit( url )
+	headers = dict( kwargs.get( "headers" ) or {} )
+	headers["X-Forwarded-Host"] = parts.netloc
+	kwargs["headers"] = headers
+	return upstream + parts.path + ( "?" + parts.query if parts.query else "" )
+
+def count( name, amount=1 ) :
+	with counter_lock :
+		counters[name] += amount
+
+def request( method, url, retries=None, **kwargs ) :
+	#	Same as requests.request, with a timeout and retries.
+	#	The last response is returned even if its status is an error.
+	import requests
+	retry_exceptions = ( requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError )
+	if retries is None :
+		retries = max_retries
+	kwargs.setdefault( "timeout", ( connect_timeout, read_timeout ) )
+	host = urlsplit( url ).netloc
+	if upstream :
+		url = upstream_request( url, kwargs )
+	for attempt in range( retries + 1 ) :
+		count( "requests" )
+		start = time.perf_counter()
+		try :
+			#	The limit isn't held while waiting to retry
+			with host_limit( host ) :
+				response = get_session().request( method, url, **kwargs )
+		except retry_exceptions as error :
+			metrics.http_seconds.observe( time.perf_counter() - start, host=host )
+			metrics.http_requests.inc( host=host, status="error" )
+			if attempt == retries :
+				raise
+			delay = backoff( attempt )
+			print( f"Retrying {url} in {delay:.1f}s - {error.__class__.__name__}" )
+		else :
+			metrics.http_seconds.observe( time.perf_counter() - start, host=host )
+			metrics.http_requests.inc( host=host, status=response.status_code )
+			timing.add_downloaded( len( response.content ) )
+			if response.status_code not in retry_statuses or attempt == retries :
+				return response
+			delay = retry_after( response )
+			if delay is None :
+				delay = backoff( attempt )
+			print( f"Retrying {url} in {delay:.1f}s - HTTP {response.status_code}" )
+		count( "retries" )
+		metrics.http_retries.inc( host=host )
+		time.sleep( delay )
+
+def get( url, **kwargs ) :
+	return request( "GET", url, **kwargs )
+
+def post( url, **kwargs ) :
+	return request( "POST", url, **kwargs )
+
+def stats() :
+	#	New connections are counted by each host's connection pool
+	connections = 0
+	pool_requests = 0
+	if session is not None :
+		#	The same adapter is mounted for http:// and https://
+		adapters = { id( adapter ): adapter for adapter in session.adapters.values() }
+		for adapter in adapters.values() :
+			pools = adapter.poolmanager.pools
+			for key in list( pools.keys() ) :
+				pool = pools.get( key )
+				if pool is not None :
+					connections   += pool.num_connections
+					pool_requests += pool.num_requests
+	with counter_lock :
+		return {
+			"requests":           counters["requests"],
+			"retries":            counters["retries"],
+			"connections":        connections,
+			"reused_connections": max( 0, pool_requests - connections ),
+		}
+
+def summary() :
+	http_stats = stats()
+	return ( f"HTTP: {http_stats['requests']} requests, {http_stats['retries']} retries, "
+		f"{http_stats['connections']} connections opened, {http_stats['reused_connections']} reused" )
@@ -0,0 +1,69 @@
+#   Encoded images written as files, for linking to instead of inlining.
+#   Each file is named after a hash of its contents, so it can be cached forever,
+#   and an avatar used by thousands of embeds is only stored once.
+#   Used by embed_images when --assets-dir is set.
+
+#   File and Bits
+import hashlib
+import os
+import threading
+
+class AssetStore :
+	#	Disabled unless a directory is given, either here or with TWEET2EMBED_ASSETS_DIR
+
+	def __init__( self, directory=None, url=None ) :
+		self.directory = None
+		self.url       = None
+		self.lock    = threading.Lock()
+		self.written = set()	#	Files known to exist, so they aren't checked again
+		self.configure( directory if directory is not None else os.environ.get( "TWEET2EMBED_ASSETS_DIR" ),
+			url if url is not None else os.environ.get( "TWEET2EMBED_ASSETS_URL" ) )
+
+	def configure( self, directory, url=None, relative_to=None ) :
+		#	url is where the directory will be served from.
+		#	Defaults to the directory's path, from the relative_to directory the HTML is saved in
+		self.directory = directory or None
+		if self.directory is None :
+			self.url = None
+		elif url or relative_to is None :
+			self.url = ( url or self.directory ).rstrip("/")
+		else :
+			self.url = os.path.relpath( self.directory, relative_to ).replace( os.sep, "/" )
+
+	@property
+	def enabled( self ) :
+		return self.directory is not None
+
+	def file_name( self, data, extension ) :
+		return hashlib.sha256( data ).hexdigest()[:32] + "." + extension
+
+	def save( self, data, extension="webp" ) :
+		#	Write the file if it isn't there already. Returns its URl
+		file_name = self.file_name( data, extension )
+		with self.lock :
+			known = file_name in self.written
+		if not known :
+			asset_path = os.path.join( self.directory, file_name )
+			if not os.path.exists( asset_path ) :
+				os.makedirs( self.directory, exist_ok = True )
+				#	Write then rename so a web server never sends a partial file
+				temp_path = f"{asset_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+				with open( temp_path, 'wb' ) as asset_file :
+					asset_file.write( data )
+				os.replace( temp_path, asset_path )
+			with self.lock :
+				self.written.add( file_name )
+		return f"{self.url}/{file_name}"
+
+	def summary( self ) :
+		with self.lock :
+			return f"Images: {len( self.written )} files in {self.directory}"
+
+def add_assets_arguments( arguments ) :
+	arguments.add_argument("--assets-dir", type=str, metavar="DIR", default=os.environ.get( "TWEET2EMBED_ASSETS_DIR" ),
+		help="Write images to this directory and link to them, instead of inlining them (default $TWEET2EMBED_ASSETS_DIR)", required=False)
+	arguments.add_argument("--assets-url", type=str, metavar="URL", default=os.environ.get( "TWEET2EMBED_ASSETS_URL" ),
+		help="Where the --assets-dir images will be served from, relative or absolute (default the directory's path, from where the HTML is saved)", required=False)
+
+#	Shared store used by the scripts
+asset_store = AssetStore()
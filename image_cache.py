@@ -0,0 +1,198 @@
+#   Persistent cache of encoded images.
+#   Shared by tweet2html and mastodon2html so that avatars, badges, and emoji
+#   are only downloaded and encoded once.
+
+#   File and Bits
+import hashlib
+import json
+import os
+import threading
+import time
+
+#   Etc
+import metrics
+
+#   Defaults can be changed with environment variables
+default_directory = os.path.join( os.path.expanduser("~"), ".cache", "tweet2embed", "images" )
+default_max_mb    = 256
+
+class ImageCache :
+	#	Encoded image bytes are stored on disk under a hash of the source URl and encode settings.
+	#	The file's modification time is when it was stored (used for the TTL).
+	#	The file's access time is when it was last used (used for LRU eviction).
+
+	def __init__( self, directory=None, max_bytes=None, ttl=None ) :
+		self.directory = directory if directory is not None else os.environ.get( "TWEET2EMBED_CACHE_DIR", default_directory )
+		if max_bytes is None :
+			max_bytes = int( float( os.environ.get( "TWEET2EMBED_CACHE_MB", default_max_mb ) ) * 1024 * 1024 )
+		self.max_bytes = max_bytes
+		if ttl is None and os.environ.get( "TWEET2EMBED_CACHE_TTL", "" ) != "" :
+			ttl = float( os.environ["TWEET2EMBED_CACHE_TTL"] )
+		self.ttl = ttl	#	Seconds. None means entries never expire
+		self.enabled = os.environ.get( "TWEET2EMBED_CACHE", "1" ) != "0"
+
+		self.lock  = threading.Lock()
+		self.size  = None	#	Total bytes on disk, calculated on first write
+		#	Counters
+		self.hits         = 0
+		self.misses       = 0
+		self.hit_bytes    = 0
+		self.miss_seconds = 0.0
+
+	def key( self, url, settings ) :
+		settings_str = json.dumps( settings, sort_keys=True )
+		return hashlib.sha256( f"{url}\n{settings_str}".encode("utf-8") ).hexdigest()
+
+	def path( self, key ) :
+		return os.path.join( self.directory, f"{key}.bin" )
+
+	def get( self, url, settings ) :
+		#	Returns the cached bytes, or None
+		if not self.enabled :
+			return None
+		cache_path = self.path( self.key( url, settings ) )
+		try :
+			stored = os.stat( cache_path ).st_mtime
+			if self.ttl is not None and time.time() - stored > self.ttl :
+				return None
+			with open( cache_path, 'rb' ) as cache_file :
+				data = cache_file.read()
+			#	Mark as recently used, keeping the stored time
+			os.utime( cache_path, ( time.time(), stored ) )
+		except OSError :
+			return None
+		return data
+
+	def put( self, url, settings, data ) :
+		if not self.enabled :
+			return
+		cache_path = self.path( self.key( url, settings ) )
+		#	An expired or re-encoded entry is replaced, so its old size no longer counts
+		try :
+			replaced = os.stat( cache_path ).st_size
+		except OSError :
+			replaced = 0
+		try :
+			os.makedirs( self.directory, exist_ok = True )
+			#	Write then rename so other processes never see a partial file
+			temp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+			with open( temp_path, 'wb' ) as cache_file :
+				cache_file.write( data )
+			os.replace( temp_path, cache_path )
+		except OSError :
+			return
+		with self.lock :
+			if self.size is None :
+				self.size = self.disk_size()
+			else :
+				self.size += len( data ) - replaced
+			if self.size > self.max_bytes :
+				self.evict()
+
+	def record_hit( self, data ) :
+		metrics.image_cache_requests.inc( result="hit" )
+		with self.lock :
+			self.hits      += 1
+			self.hit_bytes += len( data )
+
+	def record_miss( self, seconds ) :
+		#	Seconds spent producing the data which wasn't cached
+		metrics.image_cache_requests.inc( result="miss" )
+		with self.lock :
+			self.misses       += 1
+			self.miss_seconds += seconds
+
+	def fetch( self, url, settings, produce ) :
+		#	Get the bytes from the cache, or call produce() and store the result
+		data = self.get( url, settings )
+		if data is not None :
+			self.record_hit( data )
+			return data
+		start = time.perf_counter()
+		data  = produce()
+		self.record_miss( time.perf_counter() - start )
+		self.put( url, settings, data )
+		return data
+
+	def entries( self ) :
+		#	List of ( path, size, last used ) for everything in the cache
+		entries = []
+		try :
+			with os.scandir( self.directory ) as files :
+				for entry in files :
+					if entry.name.endswith( ".bin" ) :
+						stat = entry.stat()
+						entries.append( ( entry.path, stat.st_size, stat.st_atime ) )
+		except OSError :
+			pass
+		return entries
+
+	def disk_size( self ) :
+		return sum( size for _, size, _ in self.entries() )
+
+	def evict( self ) :
+		#	Remove the least recently used entries until the cache is under its size cap.
+		#	Called with the lock held.
+		entries = sorted( self.entries(), key=lambda entry: entry[2] )
+		self.size = sum( size for _, size, _ in entries )
+		for cache_path, size, _ in entries :
+			if self.size <= self.max_bytes :
+				break
+			try :
+				os.remove( cache_path )
+				self.size -= size
+			except OSError :
+				pass
+
+	def stats_path( self ) :
+		return os.path.join( self.directory, "stats.json" )
+
+	def lifetime_stats( self ) :
+		#	Counters from previous runs
+		try :
+			with open( self.stats_path(), 'r', encoding="utf-8" ) as stats_file :
+				return json.load( stats_file )
+		except ( OSError, ValueError ) :
+			return { "hits": 0, "misses": 0, "miss_seconds": 0.0 }
+
+	def save_stats( self ) :
+		#	Add this run's counters to the lifetime counters
+		if not self.enabled :
+			return
+		lifetime = self.lifetime_stats()
+		with self.lock :
+			lifetime["hits"]         += self.hits
+			lifetime["misses"]       += self.misses
+			lifetime["miss_seconds"] += self.miss_seconds
+		try :
+			os.makedirs( self.directory, exist_ok = True )
+			with open( self.stats_path(), 'w', encoding="utf-8" ) as stats_file :
+				json.dump( lifetime, stats_file )
+		except OSError :
+			pass
+
+	def stats( self ) :
+		lifetime = self.lifetime_stats()
+		with self.lock :
+			lookups   = self.hits + self.misses
+			hit_ratio = self.hits / lookups if lookups > 0 else 0.0
+			#	Each hit saves roughly the average cost of a miss
+			misses       = lifetime["misses"]       + self.misses
+			miss_seconds = lifetime["miss_seconds"] + self.miss_seconds
+			miss_average = miss_seconds / misses if misses > 0 else 0.0
+			return {
+				"hits":          self.hits,
+				"misses":        self.misses,
+				"hit_ratio":     hit_ratio,
+				"hit_bytes":     self.hit_bytes,
+				"miss_seconds":  self.miss_seconds,
+				"saved_seconds": self.hits * miss_average,
+			}
+
+	def summary( self ) :
+		stats = self.stats()
+		return ( f"Image cache: {stats['hits']} hits, {stats['misses']} misses ({stats['hit_ratio']:.0%} hit ratio), "
+			f"about {stats['saved_seconds']:.2f}s of downloading and encoding saved" )
+
+#	Shared cache used by the scripts
+image_cache = ImageCache()
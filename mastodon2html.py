@@ -4,99 +4,68 @@
 import argparse
 
 #   File and Bits
-import io
 import os
-import tempfile
 
 #   Image Manipulation
-from PIL import Image
+from embed_images import image_to_inline, images_to_inline
+from image_cache import image_cache
+from image_assets import asset_store, add_assets_arguments
+from fetch_engine import status_image_urls, prefetch_images, release_images
+from custom_emoji import used_emojis, emojis_to_html, replace_emojis
 
 #   Etc
-import requests
-import pyperclip
-import base64
+#   dateutil, pyperclip, and requests are imported where they are used,
+#   so that runs which exit early start quickly
+import http_client
+import metrics
+import timing
 import html
 
-#	Date manipulation
-from dateutil import parser
-
 #	Formatting
 import locale
-locale.setlocale(locale.LC_ALL, '')
 
 #	URl manipulation
 import urllib
 from urllib.parse import urlparse
 
-#   Command line options
-arguments = argparse.ArgumentParser(
-	prog="mastodon2html",
-	description="Convert a Tweet ID to semantic HTML")
-arguments.add_argument("id", type=str,                        help="URl of the Mastodon post")
-arguments.add_argument("-t", "--thread", action="store_true", help="Show the thread (default false)", required=False)
-arguments.add_argument("-c", "--css",    action="store_true", help="Copy the CSS (default false)",    required=False)
-arguments.add_argument("-p", "--pretty", action="store_true", help="Pretty Print the output (default false)",    required=False)
-arguments.add_argument("-s", "--save",   action="store_true", help="Save the output to a file (default false)",    required=False)
-arguments.add_argument("-m", "--schema", action='store_true', help="Add Schema.org metadata (default false)",    required=False)
-
-args = arguments.parse_args()
-
-#	Get Mastodon information
-mastodon_url   = args.id
-mastodon_parts = urlparse( mastodon_url )
-mastodon_host  = mastodon_parts.netloc
-mastodon_path  = mastodon_parts.path
-mastodon_id    = mastodon_path.split("/")[-1] #	Last element of /@example/123456
-mastodon_api   = f"https://{mastodon_host}/api/v1/statuses/{mastodon_id}"
-
-#	Get settings from arguments
-thread_show  = True if args.thread else False
-css_show     = True if args.css    else False
-pretty_print = True if args.pretty else False
-save_file    = True if args.save   else False
-schema_org   = True if args.schema else False
-
-def image_to_inline( url ) : 
-	#	Download the image
-	image_file = requests.get( url )
-	#	Convert to bytes
-	image_file = Image.open( io.BytesIO( image_file.content ) )
-	#	Temp file name with only alphanumeric characters
-	temp_file_name = "".join(x for x in url if x.isalnum())
-	#	Full path of the image
-	output_img = os.path.join( tempfile.gettempdir() , f"{temp_file_name}.webp" )
-	#	Save as a low quality WebP
-	image_file.save( output_img, 'webp', optimize=True, quality=60 )
-	#   Convert image to base64 data URl
-	#	Read the image from disk
-	binary_img      = open( output_img, 'rb' ).read()
-	#	Encode to Base64
-	base64_utf8_str = base64.b64encode( binary_img ).decode('utf-8')
-	#	Delete the temporary file
-	os.remove( output_img )
-	#	Return as data encoded suitable for an <img src="...">
-	return f'data:image/webp;base64,{base64_utf8_str}'
-
-def mastodon_emojis( mastodon_text, emojis ) :
-	for emoji in emojis:
-		shortcode = emoji["shortcode"]
-		url	      = emoji["url"]
-		emoji_img = image_to_inline( url )
-		emoji_img_html = f'<img src="{emoji_img}" alt=":{shortcode}:" class="social-embed-emoji">'
-		mastodon_text = mastodon_text.replace( f":{shortcode}:", emoji_img_html )
-	return mastodon_text
+#   Save directory
+output_directory = "output"
+
+#	Options for render_status
+default_options = {
+	"thread": False,	#	Show the thread
+	"css":    False,	#	Add the CSS to the output
+	"pretty": False,	#	Pretty print the output
+	"schema": False,	#	Add Schema.org metadata
+	"replies": False,	#	Show the replies as well, when showing the thread
+	"depth":   10,		#	Most posts to show above this one, and deepest replies to show below it
+	"fan_out": 5,		#	Most replies to show to any one post
+}
+
+def status_options( options=None ) :
+	#	Fill in any options which weren't given
+	merged = dict( default_options )
+	if options is not None :
+		merged.update( options )
+	return merged
+
+def mastodon_emojis( mastodon_text, emojis, host ) :
+	#	Only the emoji which are used are fetched
+	used = used_emojis( [ mastodon_text ], emojis )
+	if not used :
+		return mastodon_text
+	return replace_emojis( mastodon_text, emojis_to_html( host, used ) )
 
 
 def get_media( media_attachments) :
 	media_html = '<div class="social-embed-media-grid">'
+	#	Convert small version of all the media to embedded images at once
+	print( f"Embedding {len(media_attachments)} media…" )
+	media_imgs = images_to_inline( [ media["preview_url"] for media in media_attachments ] )
 	#	Iterate through the attached media
-	for media in media_attachments :
+	for media, media_img in zip( media_attachments, media_imgs ) :
 		media_type = media["type"]
 
-		#	Convert small version of media to embedded WebP
-		print( "Embedding media…" )
-		media_img = image_to_inline( media["preview_url"] )
-		
 		#	Find alt text
 		media_alt = ""
 		if "description" in media :
@@ -181,7 +150,7 @@ def get_card_html( card_data ) :
 			card_thumbnail = card_data["image"]
 			if card_thumbnail is not None:
 				#   Convert  media to embedded WebP
-				card_thumbnail = image_to_inline( card_thumbnail )
+				card_thumbnail = image_to_inline( card_thumbnail, "card" )
 				card_thumbnail_html = f'''
 					<div class="social-embed-media-grid">
 						<img src="{card_thumbnail}" alt="{card_thumbnail_alt}" class="social-embed-media">
@@ -201,17 +170,23 @@ def get_card_html( card_data ) :
 		'''
 		return card_html
 
-def mastodon_to_html( mastodon_data ) :
-	#	Show the thread / quote?
-	# tweet_parent = ""
-	# tweet_quote  = ""
-	# if thread_show :
-	# 	if "parent" in tweet_data :
-	# 		print( "Parent detected…" )
-	# 		tweet_parent = tweet_to_html( tweet_data["parent"] )
-	# 	if "quoted_tweet" in tweet_data :
-	# 		print( "Quote detected…" )
-	# 		tweet_quote = tweet_to_html( tweet_data["quoted_tweet"] )
+def mastodon_to_html( mastodon_data, options ) :
+	#	Date manipulation
+	from dateutil import parser
+
+	schema_org = options["schema"]
+
+	#	Show the thread?
+	#	The posts above this one are embedded at the top, oldest first. Replies are embedded at the bottom
+	mastodon_ancestors = ""
+	mastodon_thread_replies = ""
+	if options["thread"] :
+		if mastodon_data.get( "ancestors" ) :
+			print( f"{len(mastodon_data['ancestors'])} posts above this one…" )
+			for ancestor in mastodon_data["ancestors"] :
+				mastodon_ancestors += mastodon_to_html( ancestor, options )
+		for reply in mastodon_data.get( "replies" ) or [] :
+			mastodon_thread_replies += mastodon_to_html( reply, options )
 
 	#	Take the data from the API of a single Tweet (which might also be a quote or reply).
 	#	Create a semantic HTML representation
@@ -245,8 +220,9 @@ def mastodon_to_html( mastodon_data ) :
 		user_badge = ""
 
 	#	Get the datetime
-	mastodon_time = parser.parse( mastodon_date )
-	mastodon_time = mastodon_time.strftime('%H:%M - %a %d %B %Y')
+	with timing.span( "date.parse" ) :
+		mastodon_time = parser.parse( mastodon_date )
+		mastodon_time = mastodon_time.strftime('%H:%M - %a %d %B %Y')
 
 	#	Is this a reply?
 	# if "in_reply_to_screen_name" in tweet_data :
@@ -265,10 +241,10 @@ def mastodon_to_html( mastodon_data ) :
 	# #   Embed entities
 	# tweet_text = tweet_entities_to_html( tweet_text, tweet_entities )
 
-	#	Add shortcode emoji to text
-	if "emojis" in mastodon_data :
-		if mastodon_data["emojis"] is not None :
-			mastodon_text = mastodon_emojis( mastodon_text, mastodon_data["emojis"] )
+	#	Add shortcode emoji to text and display name
+	with timing.span( "emoji" ) :
+		mastodon_text = mastodon_emojis( mastodon_text, mastodon_data.get( "emojis" ), mastodon_domain )
+		user_display  = mastodon_emojis( user_display, mastodon_data["account"].get( "emojis" ), mastodon_domain )
 
 	#	Add media
 	mastodon_media = ""
@@ -288,9 +264,9 @@ def mastodon_to_html( mastodon_data ) :
 		if mastodon_data["poll"] is not None :
 			mastodon_poll = get_poll_html( mastodon_data["poll"] )
 
-	#   Convert avatar to embedded WebP
+	#   Convert avatar to an embedded image
 	print( "Storing avatar…")
-	mastodon_avatar = image_to_inline( user_avatar )
+	mastodon_avatar = image_to_inline( user_avatar, "avatar" )
 
 	#	Schema.org metadata
 	schema_post   = ' itemscope itemtype="https://schema.org/SocialMediaPosting"'       if schema_org else ""
@@ -304,6 +280,7 @@ def mastodon_to_html( mastodon_data ) :
 	#   HTML
 	mastodon_html = f'''
 	<blockquote class="social-embed" id="social-embed-{mastodon_id}" lang="{mastodon_language}"{schema_post}>
+		{mastodon_ancestors}
 		<header class="social-embed-header"{schema_author}>
 			<a href="{user_url}" class="social-embed-user"{schema_url}>
 				<img class="social-embed-avatar" src="{mastodon_avatar}" alt=""{schema_image}>
@@ -328,32 +305,11 @@ def mastodon_to_html( mastodon_data ) :
 				<time datetime="{mastodon_date}"{schema_time}>{mastodon_time}</time>
 			</a>
 		</footer>
+		{mastodon_thread_replies}
 	</blockquote>
 	'''
 	return mastodon_html
 
-#   Get the data from the Mastodon API
-for _ in range(5):
-	#	Lazy retry strategy
-	try :
-		print( f"Downloading {mastodon_api}" )
-		response = requests.get( mastodon_api )
-		data = response.json()
-		break
-	except :
-		print( "Retrying…" )
-		continue
-
-#	If Post was deleted, exit.
-if "error" in data :
-	print( "This post doesn't exist." )
-	raise SystemExit
-
-#	Turn the Tweet into HTML
-mastodon_html = mastodon_to_html( data )
-
-#   Generate Content to be pasted
-
 #	CSS
 mastodon_css = '''
 <style>
@@ -493,37 +449,215 @@ blockquote.social-embed{
 </style>
 '''
 
-#   Compact the output if necessary
-if not pretty_print :
-	print( "Compacting…")
-	mastodon_html = mastodon_html.replace("\n", "").replace("\t", "")
-	mastodon_css  = mastodon_css.replace("\n", "").replace("\t", "")
-	#	Inline CSS
-	mastodon_css = '<link rel="stylesheet" type="text/css" href="data:text/css,' + urllib.parse.quote(mastodon_css) + '">'
-
-#	Add the CSS to the output if requsted
-if css_show :
-	mastodon_html = mastodon_css + mastodon_html
-
-#   Copy to clipboard
-pyperclip.copy( mastodon_html )
+def status_api_url( mastodon_url ) :
+	#	Get Mastodon information
+	mastodon_parts = urlparse( mastodon_url )
+	mastodon_host  = mastodon_parts.netloc
+	mastodon_path  = mastodon_parts.path
+	mastodon_id    = mastodon_path.split("/")[-1] #	Last element of /@example/123456
+	return f"https://{mastodon_host}/api/v1/statuses/{mastodon_id}"
+
+def get_status( mastodon_url ) :
+	#   Get the data from the Mastodon API. The client retries if it can.
+	#	Returns None if it couldn't be downloaded
+	import requests
+	mastodon_api = status_api_url( mastodon_url )
+	try :
+		print( f"Downloading {mastodon_api}" )
+		with timing.span( "fetch.status" ) :
+			response = http_client.get( mastodon_api )
+			return response.json()
+	except ( requests.RequestException, ValueError ) as error :
+		print( f"Couldn't download {mastodon_api} - {error}" )
+		return None
+
+def get_context( mastodon_url ) :
+	#	The posts above and below this one in its thread.
+	#	Returns None if it couldn't be downloaded
+	import requests
+	context_api = status_api_url( mastodon_url ) + "/context"
+	try :
+		print( f"Downloading {context_api}" )
+		with timing.span( "fetch.context" ) :
+			response = http_client.get( context_api )
+			context = response.json()
+	except ( requests.RequestException, ValueError ) as error :
+		print( f"Couldn't download {context_api} - {error}" )
+		return None
+	if not isinstance( context, dict ) or "error" in context :
+		print( f"Couldn't download {context_api} - {context}" )
+		return None
+	return context
+
+def reply_tree( status_id, replies, depth, fan_out ) :
+	#	The replies to a post, each with their own replies, up to depth levels down and fan_out wide
+	if depth <= 0 :
+		return []
+	tree = []
+	for reply in replies.get( status_id, [] )[:fan_out] :
+		reply = dict( reply )
+		reply["replies"] = reply_tree( reply["id"], replies, depth - 1, fan_out )
+		tree.append( reply )
+	return tree
+
+def add_thread( mastodon_data, context, options ) :
+	#	A copy of the post with its "ancestors" and "replies", within the depth and fan out limits
+	mastodon_data = dict( mastodon_data )
+	ancestors = ( context or {} ).get( "ancestors" ) or []
+	mastodon_data["ancestors"] = ancestors[ -options["depth"]: ] if options["depth"] > 0 else []
+	replies = {}
+	if options["replies"] :
+		#	Descendants are a flat list, so group them by the post they reply to
+		for descendant in ( context or {} ).get( "descendants" ) or [] :
+			replies.setdefault( descendant.get( "in_reply_to_id" ), [] ).append( descendant )
+	mastodon_data["replies"] = reply_tree( mastodon_data["id"], replies, options["depth"], options["fan_out"] )
+	return mastodon_data
+
+def get_thread( mastodon_url, options=None ) :
+	#	Like get_status. When the thread is shown, its context is downloaded at the same time as the post
+	options = status_options( options )
+	if not options["thread"] :
+		return get_status( mastodon_url )
+	from concurrent.futures import ThreadPoolExecutor
+	with ThreadPoolExecutor( max_workers=1 ) as context_pool :
+		context_future = context_pool.submit( get_context, mastodon_url )
+		data = get_status( mastodon_url )
+		context = context_future.result()
+	if data is None or "error" in data :
+		return data
+	return add_thread( data, context, options )
+
+def render_status( mastodon_data, options=None ) :
+	#	Turn the post's data into the HTML to be pasted.
+	#	options is a dict with any of the keys in default_options
+	options = status_options( options )
+	if options["thread"] and "ancestors" not in mastodon_data :
+		#	Data from get_status doesn't have the thread yet
+		mastodon_data = add_thread( mastodon_data, get_context( mastodon_data["url"] ), options )
+	#	Fetch every image the post needs at once, then turn it into HTML
+	held_urls = prefetch_images( status_image_urls( mastodon_data ) )
+	try :
+		with timing.span( "template" ) :
+			mastodon_html = mastodon_to_html( mastodon_data, options )
+	finally :
+		release_images( held_urls )
+	with timing.span( "minify" ) :
+		mastodon_html = mastodon_html_output( mastodon_html, options )
+	metrics.renders.inc( kind="status" )
+	metrics.output_bytes.observe( len( mastodon_html.encode("utf-8") ), kind="status" )
+	return mastodon_html
 
-#   Print to say we've finished
-print( f"Copied {mastodon_url}" )
+def mastodon_html_output( mastodon_html, options ) :
+	css_html = mastodon_css
+	#   Compact the output if necessary
+	if not options["pretty"] :
+		print( "Compacting…")
+		mastodon_html = mastodon_html.replace("\n", "").replace("\t", "")
+		css_html      = css_html.replace("\n", "").replace("\t", "")
+		#	Inline CSS
+		css_html = '<link rel="stylesheet" type="text/css" href="data:text/css,' + urllib.parse.quote(css_html) + '">'
+
+	#	Add the CSS to the output if requsted
+	if options["css"] :
+		mastodon_html = css_html + mastodon_html
+	return mastodon_html
 
-if save_file :
+def save_html( mastodon_url, mastodon_html ) :
 	#	Save HTML
-	#   Save directory
-	output_directory = "output"
 	os.makedirs(output_directory, exist_ok = True)
 	#	Make URl filename safe
 	mastodon_file_name = "".join(x for x in mastodon_url if x.isalnum())
 	save_location = os.path.join( output_directory, f"{mastodon_file_name}.html" ) 
 	#   Save as HTML file
-	with open( save_location, 'w', encoding="utf-8" ) as html_file:
+	with timing.span( "save" ), open( save_location, 'w', encoding="utf-8" ) as html_file:
 		html_file.write( mastodon_html )
 	print( f"Saved to {save_location}" )
-
-#	Submit the Tweet to Archive.org
-print( f"Archiving… {mastodon_url}" )
-requests.post( "https://web.archive.org/save/", data={"url": mastodon_url, "capture_all":"on"}, timeout=5 )
+	return save_location
+
+def archive_status( mastodon_url ) :
+	#	Submit the post to Archive.org
+	print( f"Archiving… {mastodon_url}" )
+	with timing.span( "archive" ) :
+		try :
+			response = http_client.post( "https://web.archive.org/save/", data={"url": mastodon_url, "capture_all":"on"}, timeout=5, retries=0 )
+		except Exception :
+			metrics.archive_submissions.inc( result="failed" )
+			raise
+	metrics.archive_submissions.inc( result="ok" if response.ok else "failed" )
+
+def main() :
+	#   Command line options
+	arguments = argparse.ArgumentParser(
+		prog="mastodon2html",
+		description="Convert a Tweet ID to semantic HTML")
+	arguments.add_argument("id", type=str,                        help="URl of the Mastodon post")
+	arguments.add_argument("-t", "--thread", action="store_true", help="Show the thread (default false)", required=False)
+	arguments.add_argument("-r", "--replies", action="store_true", help="Show the replies as well as the thread (default false)", required=False)
+	arguments.add_argument("-d", "--depth", type=int, default=default_options["depth"],   help=f"Most posts to show above, and levels of replies below (default {default_options['depth']})", required=False)
+	arguments.add_argument("--fan-out", type=int, default=default_options["fan_out"], help=f"Most replies to show to each post (default {default_options['fan_out']})", required=False)
+	arguments.add_argument("-c", "--css",    action="store_true", help="Copy the CSS (default false)",    required=False)
+	arguments.add_argument("-p", "--pretty", action="store_true", help="Pretty Print the output (default false)",    required=False)
+	arguments.add_argument("-s", "--save",   action="store_true", help="Save the output to a file (default false)",    required=False)
+	arguments.add_argument("-m", "--schema", action='store_true', help="Add Schema.org metadata (default false)",    required=False)
+	timing.add_profile_arguments( arguments )
+	metrics.add_metrics_arguments( arguments )
+	add_assets_arguments( arguments )
+
+	args = arguments.parse_args()
+	with timing.profile( "mastodon2html", args.profile, args.cprofile ), metrics.textfile( args.metrics ) :
+		run( args )
+
+def run( args ) :
+	#	Everything main() does once the arguments have been read
+
+	#	Number formatting follows the user's locale
+	locale.setlocale(locale.LC_ALL, '')
+
+	#	Get settings from arguments
+	mastodon_url = args.id
+	options = status_options( {
+		"thread": args.thread,
+		"css":    args.css,
+		"pretty": args.pretty,
+		"schema": args.schema,
+		"replies": args.replies,
+		"depth":   args.depth,
+		"fan_out": args.fan_out,
+	} )
+	save_file = True if args.save else False
+
+	#	Link to image files instead of inlining them? Saved HTML links to them from the output directory
+	asset_store.configure( args.assets_dir, args.assets_url, relative_to=output_directory if save_file else None )
+
+	data = get_thread( mastodon_url, options )
+	if data is None :
+		raise SystemExit
+
+	#	If Post was deleted, exit.
+	if "error" in data :
+		print( "This post doesn't exist." )
+		raise SystemExit
+
+	#	Turn the post into HTML
+	mastodon_html = render_status( data, options )
+
+	#   Copy to clipboard
+	import pyperclip
+	with timing.span( "clipboard" ) :
+		pyperclip.copy( mastodon_html )
+
+	#   Print to say we've finished
+	print( f"Copied {mastodon_url}" )
+	print( image_cache.summary() )
+	if asset_store.enabled :
+		print( asset_store.summary() )
+	print( http_client.summary() )
+	image_cache.save_stats()
+
+	if save_file :
+		save_html( mastodon_url, mastodon_html )
+
+	archive_status( mastodon_url )
+
+if __name__ == "__main__" :
+	main()
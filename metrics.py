@@ -0,0 +1,151 @@
+#   Counters and histograms for graphing bulk runs, in Prometheus' text format.
+#   Scripts write them to a file at the end of a run, for node_exporter's textfile collector.
+#   embed_server serves them on /metrics.
+
+#   File and Bits
+import os
+import threading
+
+#   Timing
+import time
+from contextlib import contextmanager
+
+#	Prometheus' default buckets, for seconds
+seconds_buckets = ( 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30 )
+#	For sizes, from 1KB to 4MB
+bytes_buckets   = ( 1024, 4096, 16384, 65536, 262144, 1048576, 4194304 )
+
+registry = []
+registry_lock = threading.Lock()
+
+def escape( value ) :
+	return str( value ).replace( "\\", "\\\\" ).replace( "\n", "\\n" ).replace( '"', '\\"' )
+
+def format_number( value ) :
+	if value == float( "inf" ) :
+		return "+Inf"
+	return repr( value ) if isinstance( value, float ) else str( value )
+
+def format_labels( names, values, bound=None ) :
+	pairs = [ f'{name}="{escape( value )}"' for name, value in zip( names, values ) ]
+	if bound is not None :
+		pairs.append( 'le="' + format_number( float( bound ) ) + '"' )
+	return "{" + ",".join( pairs ) + "}" if pairs else ""
+
+class Metric :
+	kind = "untyped"
+
+	def __init__( self, name, description, labels=() ) :
+		self.name        = name
+		self.description = description
+		self.labels      = tuple( labels )
+		self.lock   = threading.Lock()
+		self.values = {}	#	Label values -> value
+		if not self.labels :
+			#	Start at zero, so it's graphed before the first event
+			self.values[()] = self.zero()
+		with registry_lock :
+			registry.append( self )
+
+	def zero( self ) :
+		return 0
+
+	def key( self, labels ) :
+		return tuple( str( labels.get( name, "" ) ) for name in self.labels )
+
+	def render( self ) :
+		lines = [ f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}" ]
+		with self.lock :
+			for key, value in sorted( self.values.items() ) :
+				lines += self.samples( key, value )
+		return lines
+
+	def samples( self, key, value ) :
+		return [ f"{self.name}{format_labels( self.labels, key )} {format_number( value )}" ]
+
+class Counter( Metric ) :
+	kind = "counter"
+
+	def inc( self, amount=1, **labels ) :
+		key = self.key( labels )
+		with self.lock :
+			self.values[key] = self.values.get( key, 0 ) + amount
+
+class Gauge( Metric ) :
+	kind = "gauge"
+
+	def set( self, value, **labels ) :
+		with self.lock :
+			self.values[ self.key( labels ) ] = value
+
+class Histogram( Metric ) :
+	kind = "histogram"
+
+	def __init__( self, name, description, labels=(), buckets=seconds_buckets ) :
+		self.buckets = tuple( buckets )
+		super().__init__( name, description, labels )
+
+	def zero( self ) :
+		return ( [ 0 ] * len( self.buckets ), 0.0, 0 )
+
+	def observe( self, value, **labels ) :
+		key = self.key( labels )
+		with self.lock :
+			counts, total, observations = self.values.get( key, self.zero() )
+			#	Bucket counts are cumulative, as Prometheus expects
+			for index, bound in enumerate( self.buckets ) :
+				if value <= bound :
+					counts[index] += 1
+			self.values[key] = ( counts, total + value, observations + 1 )
+
+	def samples( self, key, value ) :
+		counts, total, observations = value
+		lines = [ f"{self.name}_bucket{format_labels( self.labels, key, bound )} {count}" for bound, count in zip( self.buckets, counts ) ]
+		lines.append( f"{self.name}_bucket{format_labels( self.labels, key, float( 'inf' ) )} {observations}" )
+		lines.append( f"{self.name}_sum{format_labels( self.labels, key )} {format_number( float( total ) )}" )
+		lines.append( f"{self.name}_count{format_labels( self.labels, key )} {observations}" )
+		return lines
+
+#	Everything the scripts measure
+renders        = Counter( "tweet2embed_renders_total", "Posts rendered to HTML or screenshots", [ "kind" ] )
+tombstones     = Counter( "tweet2embed_tombstones_total", "Deleted Tweets found" )
+output_bytes   = Histogram( "tweet2embed_output_bytes", "Size of each rendered embed", [ "kind" ], bytes_buckets )
+http_requests  = Counter( "tweet2embed_http_requests_total", "Upstream HTTP requests, by host and status", [ "host", "status" ] )
+http_retries   = Counter( "tweet2embed_http_retries_total", "Upstream HTTP requests which were retried", [ "host" ] )
+http_seconds   = Histogram( "tweet2embed_http_request_seconds", "Time for each upstream HTTP request", [ "host" ] )
+image_cache_requests = Counter( "tweet2embed_image_cache_requests_total", "Encoded image cache lookups", [ "result" ] )
+encode_seconds = Histogram( "tweet2embed_image_encode_seconds", "Time decoding and encoding each image as WebP" )
+archive_submissions = Counter( "tweet2embed_archive_submissions_total", "Posts submitted to archive.org", [ "result" ] )
+last_run       = Gauge( "tweet2embed_last_run_timestamp_seconds", "When the run which wrote these metrics finished" )
+
+def render( exclude=() ) :
+	#	Every metric in Prometheus' text format, except those in exclude
+	with registry_lock :
+		metrics = [ metric for metric in registry if metric not in exclude ]
+	lines = []
+	for metric in metrics :
+		lines += metric.render()
+	return "\n".join( lines ) + "\n"
+
+def write_textfile( metrics_path ) :
+	#	Write then rename, so the collector never reads a partial file
+	last_run.set( time.time() )
+	temp_path = f"{metrics_path}.{os.getpid()}.tmp"
+	with open( temp_path, 'w', encoding="utf-8" ) as metrics_file :
+		metrics_file.write( render() )
+	os.replace( temp_path, metrics_path )
+	print( f"Metrics saved to {metrics_path}" )
+
+def add_metrics_arguments( arguments ) :
+	arguments.add_argument("--metrics", type=str, metavar="FILE", default=os.environ.get( "TWEET2EMBED_METRICS_FILE" ),
+		help="Save metrics in Prometheus' text format at the end of the run (default $TWEET2EMBED_METRICS_FILE)", required=False)
+
+@contextmanager
+def textfile( metrics_path=None ) :
+	#	with metrics.textfile( args.metrics ):
+	#	Writes the metrics even if the run exits early
+	try :
+		yield
+	finally :
+		if metrics_path :
+			write_textfile( metrics_path )
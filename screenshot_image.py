@@ -0,0 +1,89 @@
+#   Post-processing of screenshots.
+#   Scales a screenshot down to CSS pixels, trims its uniform border,
+#   and keeps the smallest WebP which looks close enough to the original.
+#   Used by tweet2img.
+
+#   File and Bits
+import io
+import math
+
+#	Lossy encodings are only kept if they are at least this close to the original, in dB
+min_psnr = 30
+
+def scale_screenshot( img, scale ) :
+	#	Scale down by any HiDPI scale factor
+	from PIL import Image
+
+	if scale <= 1 :
+		return img
+	if scale == int( scale ) :
+		#	Whole factors (2x, 3x) can average blocks of pixels, which is much faster than resampling
+		return img.reduce( int( scale ) )
+	#	Fractional factors reduce by the whole part first, then resample the rest
+	size = ( max( 1, round( img.width / scale ) ), max( 1, round( img.height / scale ) ) )
+	return img.resize( size, Image.Resampling.LANCZOS, reducing_gap=2.0 )
+
+def trim_border( img, margin=0 ) :
+	#	Crop away the border which is the same colour as the top left pixel, leaving margin pixels of it
+	from PIL import Image, ImageChops
+
+	background = Image.new( img.mode, img.size, img.getpixel( ( 0, 0 ) ) )
+	box = ImageChops.difference( img, background ).getbbox()
+	if box is None :
+		#	Nothing but border
+		return img
+	left, top, right, bottom = box
+	box = ( max( 0, left - margin ), max( 0, top - margin ), min( img.width, right + margin ), min( img.height, bottom + margin ) )
+	if box == ( 0, 0, img.width, img.height ) :
+		return img
+	return img.crop( box )
+
+def psnr( original, encoded ) :
+	#	Peak signal to noise ratio in dB. Higher is closer, identical is infinite
+	from PIL import ImageChops, ImageStat
+
+	squares = ImageStat.Stat( ImageChops.difference( original, encoded ) ).sum2
+	mean_square = sum( squares ) / ( len( squares ) * original.width * original.height )
+	if mean_square == 0 :
+		return math.inf
+	return 10 * math.log10( 255 * 255 / mean_square )
+
+def encode_candidates( img ) :
+	#	Yields ( name, WebP bytes, image it decodes to - or None if it is lossless )
+	from PIL import Image
+
+	def encode( source, **settings ) :
+		output_img = io.BytesIO()
+		source.save( output_img, "webp", method=4, **settings )
+		return output_img.getvalue()
+
+	binary_img = encode( img, quality=60 )
+	yield ( "lossy", binary_img, Image.open( io.BytesIO( binary_img ) ).convert( "RGB" ) )
+
+	#	Screenshots are mostly flat colour, so often fit in a palette, which lossless WebP uses automatically
+	if img.getcolors( 256 ) is not None :
+		yield ( "palette", encode( img, lossless=True, quality=50 ), None )
+		return
+	yield ( "lossless", encode( img, lossless=True, quality=50 ), None )
+	#	Otherwise reduce it to a palette, which is lossy
+	palette_img = img.quantize( 256, method=Image.Quantize.MEDIANCUT ).convert( "RGB" )
+	yield ( "palette", encode( palette_img, lossless=True, quality=50 ), palette_img )
+
+def process_screenshot( png, pixel_ratio=1, margin=8, threshold=min_psnr ) :
+	#	pixel_ratio is the browser's window.devicePixelRatio when the screenshot was taken.
+	#	Returns ( WebP bytes, width, height, name of the encoding used )
+	from PIL import Image
+
+	img = Image.open( io.BytesIO( png ) ).convert( "RGB" )
+
+	#	Trim before scaling, so there are fewer pixels to scale
+	img = trim_border( img, margin=round( margin * max( 1, pixel_ratio ) ) )
+	img = scale_screenshot( img, pixel_ratio )
+
+	best = None
+	for name, binary_img, decoded in encode_candidates( img ) :
+		if decoded is not None and psnr( img, decoded ) < threshold :
+			continue
+		if best is None or len( binary_img ) < len( best[1] ) :
+			best = ( name, binary_img )
+	return ( best[1], img.width, img.height, best[0] )
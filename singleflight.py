@@ -0,0 +1,33 @@
+#   Coalesces concurrent calls for the same key.
+#   While one caller is doing the work, everyone else asking for the same key waits for its result.
+
+#   Concurrency
+import threading
+from concurrent.futures import Future
+
+class SingleFlight :
+
+	def __init__( self ) :
+		self.lock  = threading.Lock()
+		self.calls = {}	#	Key -> Future of the call in flight
+
+	def do( self, key, function ) :
+		#	Returns function(), or the result of the same key's call which is already in flight
+		with self.lock :
+			call = self.calls.get( key )
+			leader = call is None
+			if leader :
+				call = Future()
+				self.calls[key] = call
+		if not leader :
+			return call.result()
+		try :
+			result = function()
+			call.set_result( result )
+			return result
+		except BaseException as error :
+			call.set_exception( error )
+			raise
+		finally :
+			with self.lock :
+				del self.calls[key]
@@ -0,0 +1,172 @@
+#   Tweet data from the Twitter syndication API.
+#   Responses are cached on disk and shared by tweet2html, tweet2img, and tweet2json.
+
+#   File and Bits
+import json
+import os
+import threading
+import time
+
+#   Etc
+import http_client
+import timing
+import random
+from singleflight import SingleFlight
+
+#   Defaults can be changed with environment variables
+default_directory     = os.path.join( os.path.expanduser("~"), ".cache", "tweet2embed", "tweets" )
+default_ttl           = 60 * 60           #	One hour
+default_tombstone_ttl = 60 * 60 * 24 * 7  #	One week
+
+class TweetCache :
+	#	Each Tweet is stored as {id}.json with the time it was fetched.
+	#	Deleted Tweets are stored separately in tombstones/{id}.json with a longer TTL,
+	#	so that they aren't requested again on every batch.
+
+	def __init__( self, directory=None, ttl=None, tombstone_ttl=None, stale_while_revalidate=None ) :
+		self.directory = directory if directory is not None else os.environ.get( "TWEET2EMBED_TWEET_CACHE_DIR", default_directory )
+		self.ttl = ttl if ttl is not None else float( os.environ.get( "TWEET2EMBED_TWEET_TTL", default_ttl ) )
+		self.tombstone_ttl = tombstone_ttl if tombstone_ttl is not None else float( os.environ.get( "TWEET2EMBED_TOMBSTONE_TTL", default_tombstone_ttl ) )
+		if stale_while_revalidate is None :
+			stale_while_revalidate = os.environ.get( "TWEET2EMBED_TWEET_SWR", "0" ) == "1"
+		#	Serve expired data immediately and refresh it in the background
+		self.stale_while_revalidate = stale_while_revalidate
+		self.enabled = os.environ.get( "TWEET2EMBED_CACHE", "1" ) != "0"
+		self.refreshing = set()
+		self.lock = threading.Lock()
+
+	def path( self, tweet_id, tombstone=False ) :
+		if tombstone :
+			return os.path.join( self.directory, "tombstones", f"{tweet_id}.json" )
+		return os.path.join( self.directory, f"{tweet_id}.json" )
+
+	def read( self, cache_path ) :
+		#	Returns ( data, age in seconds ) or ( None, None )
+		try :
+			with open( cache_path, 'r', encoding="utf-8" ) as cache_file :
+				cached = json.load( cache_file )
+			return ( cached["data"], time.time() - cached["fetched"] )
+		except ( OSError, ValueError, KeyError ) :
+			return ( None, None )
+
+	def get( self, tweet_id ) :
+		#	Returns ( data, fresh ). data is None if there's nothing usable
+		if not self.enabled :
+			return ( None, False )
+		data, age = self.read( self.path( tweet_id, tombstone=True ) )
+		if data is not None and age <= self.tombstone_ttl :
+			return ( data, True )
+		data, age = self.read( self.path( tweet_id ) )
+		if data is None :
+			return ( None, False )
+		return ( data, age <= self.ttl )
+
+	def put( self, tweet_id, data ) :
+		if not self.enabled :
+			return
+		tombstone  = is_tombstone( data )
+		cache_path = self.path( tweet_id, tombstone )
+		try :
+			os.makedirs( os.path.dirname( cache_path ), exist_ok = True )
+			#	Write then rename so other processes never see a partial file
+			temp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+			with open( temp_path, 'w', encoding="utf-8" ) as cache_file :
+				json.dump( { "fetched": time.time(), "data": data }, cache_file )
+			os.replace( temp_path, cache_path )
+			if not tombstone :
+				#	A Tweet which exists again shouldn't stay in the negative cache
+				if os.path.exists( self.path( tweet_id, tombstone=True ) ) :
+					os.remove( self.path( tweet_id, tombstone=True ) )
+		except OSError :
+			pass
+
+	def refresh( self, tweet_id ) :
+		#	Download a fresh copy in the background
+		with self.lock :
+			if tweet_id in self.refreshing :
+				return
+			self.refreshing.add( tweet_id )
+		def revalidate() :
+			try :
+				data = download_tweet( tweet_id )
+				if data is not None :
+					self.put( tweet_id, data )
+			finally :
+				with self.lock :
+					self.refreshing.discard( tweet_id )
+		threading.Thread( target=revalidate ).start()
+
+def is_tombstone( data ) :
+	return "TweetTombstone" == data.get( "__typename" )
+
+def download_tweet( tweet_id ) :
+	#   Get the data from the Twitter embed API. The client retries if it can.
+	import requests
+	print( "Downloading data…" )
+	token = random.randint(1,10000)
+	json_url =  f"https://cdn.syndication.twimg.com/tweet-result?id={tweet_id}&lang=en&token={token}"
+	try :
+		with timing.span( "fetch.tweet" ) :
+			response = http_client.get( json_url )
+			return response.json()
+	except ( requests.RequestException, ValueError ) as error :
+		print( f"Couldn't download {tweet_id} - {error}" )
+		return None
+
+#	Shared cache used by the scripts
+tweet_cache = TweetCache()
+
+#	Concurrent requests for the same Tweet - such as a reply chain shared by a batch - share one download
+downloads = SingleFlight()
+
+def get_tweet( tweet_id ) :
+	#	Returns the Tweet's data, or None if it couldn't be downloaded
+	tweet_id = str( tweet_id )
+	with timing.span( "cache.tweet" ) :
+		data, fresh = tweet_cache.get( tweet_id )
+	if data is not None :
+		if fresh :
+			print( "Using cached data…" )
+			return data
+		if tweet_cache.stale_while_revalidate :
+			print( "Using cached data, refreshing in the background…" )
+			tweet_cache.refresh( tweet_id )
+			return data
+	data = downloads.do( tweet_id, lambda: download_tweet( tweet_id ) )
+	if data is not None :
+		tweet_cache.put( tweet_id, data )
+	return data
+
+def get_ancestors( tweet_data, depth, known=None ) :
+	#	The Tweets which this one replies to, oldest first, following in_reply_to_status_id_str up to depth levels.
+	#	Each download includes its own parent, so it goes two levels up the chain.
+	#	known is ID -> data of Tweets which have already been downloaded, and is added to
+	if known is None :
+		known = {}
+	ancestors = []
+	current   = tweet_data
+	while len( ancestors ) < depth :
+		parent_id = current.get( "in_reply_to_status_id_str" )
+		if not parent_id :
+			break
+		parent = known.get( parent_id )
+		if parent is None and current.get( "parent", {} ).get( "id_str" ) == parent_id :
+			parent = current["parent"]
+		if parent is None :
+			print( f"Following the thread to {parent_id}…" )
+			parent = get_tweet( parent_id )
+			if parent is None or is_tombstone( parent ) :
+				break
+			known[parent_id] = parent
+		ancestors.append( parent )
+		current = parent
+	#	Each one is shown on its own, without the parent it was downloaded with
+	return [ { key: value for key, value in ancestor.items() if key != "parent" } for ancestor in reversed( ancestors ) ]
+
+def tweet_ancestors( tweet_data ) :
+	#	The Tweets shown above this one - the chain from get_ancestors, or the parent which came with it
+	if "ancestors" in tweet_data :
+		return tweet_data["ancestors"]
+	if "parent" in tweet_data :
+		return [ tweet_data["parent"] ]
+	return []
@@ -0,0 +1,125 @@
+#   Lightweight timing spans, for finding out where a slow run spends its time.
+#   Spans are only recorded while profiling, so they cost almost nothing otherwise.
+#   Used by all the scripts' --profile option.
+
+#   Concurrency
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+#	Only record spans while profiling
+enabled = False
+started = time.perf_counter()
+
+#	Totals for each stage name, and each span in the order it finished
+lock   = threading.Lock()
+stages = {}
+spans  = []
+max_spans     = 10000	#	Longer runs only keep the totals for the rest
+dropped_spans = 0
+
+#	The innermost span, so that bytes can be counted against it.
+#	asyncio.to_thread copies this into the thread it runs on
+current_span = contextvars.ContextVar( "current_span", default=None )
+
+class Span :
+	__slots__ = ( "name", "downloaded", "inlined" )
+
+	def __init__( self, name ) :
+		self.name       = name
+		self.downloaded = 0
+		self.inlined    = 0
+
+def record( name, seconds, start=None, downloaded=0, inlined=0 ) :
+	#	Add a span which has finished - including one timed in another process
+	global dropped_spans
+	if not enabled :
+		return
+	if start is None :
+		start = time.perf_counter() - seconds
+	with lock :
+		stage = stages.setdefault( name, { "count": 0, "seconds": 0.0, "max_seconds": 0.0, "downloaded_bytes": 0, "inlined_bytes": 0 } )
+		stage["count"]   += 1
+		stage["seconds"] += seconds
+		stage["max_seconds"] = max( stage["max_seconds"], seconds )
+		stage["downloaded_bytes"] += downloaded
+		stage["inlined_bytes"]    += inlined
+		if len( spans ) < max_spans :
+			spans.append( {
+				"name":    name,
+				"start":   round( start - started, 6 ),
+				"seconds": round( seconds, 6 ),
+				"thread":  threading.current_thread().name,
+			} )
+		else :
+			dropped_spans += 1
+
+@contextmanager
+def span( name ) :
+	#	with timing.span( "stage" ):
+	if not enabled :
+		yield
+		return
+	this_span = Span( name )
+	token = current_span.set( this_span )
+	start = time.perf_counter()
+	try :
+		yield
+	finally :
+		seconds = time.perf_counter() - start
+		current_span.reset( token )
+		record( name, seconds, start, this_span.downloaded, this_span.inlined )
+
+def add_downloaded( amount ) :
+	#	Bytes downloaded by the innermost span
+	if enabled and current_span.get() is not None :
+		current_span.get().downloaded += amount
+
+def add_inlined( amount ) :
+	#	Bytes of data URls added to the HTML by the innermost span
+	if enabled and current_span.get() is not None :
+		current_span.get().inlined += amount
+
+def report( script ) :
+	with lock :
+		return {
+			"script":        script,
+			"wall_seconds":  round( time.perf_counter() - started, 6 ),
+			"stages":        { name: dict( stage ) for name, stage in sorted( stages.items() ) },
+			"spans":         list( spans ),
+			"dropped_spans": dropped_spans,
+		}
+
+def add_profile_arguments( arguments ) :
+	arguments.add_argument("--profile",  type=str, metavar="FILE", help="Save how long each stage took as JSON", required=False)
+	arguments.add_argument("--cprofile", type=str, metavar="FILE", help="Save a cProfile dump of the main thread, for pstats or snakeviz", required=False)
+
+@contextmanager
+def profile( script, profile_path=None, cprofile_path=None ) :
+	#	with timing.profile( "script", args.profile, args.cprofile ):
+	#	Saves the profiles even if the run exits early
+	global enabled, started
+	if profile_path is None and cprofile_path is None :
+		yield
+		return
+	enabled = True
+	started = time.perf_counter()
+	profiler = None
+	if cprofile_path is not None :
+		import cProfile
+		profiler = cProfile.Profile()
+		profiler.enable()
+	try :
+		yield
+	finally :
+		if profiler is not None :
+			profiler.disable()
+			profiler.dump_stats( cprofile_path )
+			print( f"cProfile saved to {cprofile_path}" )
+		if profile_path is not None :
+			import json
+			with open( profile_path, 'w', encoding="utf-8" ) as profile_file :
+				json.dump( report( script ), profile_file, indent="\t" )
+			print( f"Profile saved to {profile_path}" )
+		enabled = False
@@ -3,69 +3,48 @@
 import argparse
 
 #   File and Bits
-import io
 import os
-import tempfile
+import sys
+
+#   Batch mode
+import time
 
 #   Image Manipulation
-from PIL import Image
+from embed_images import image_to_inline, images_to_inline
+from image_cache import image_cache
+from image_assets import asset_store, add_assets_arguments
+from fetch_engine import tweet_image_urls, prefetch_images, release_images
+from syndication import get_tweet, is_tombstone, get_ancestors, tweet_ancestors
 
 #   Etc
-import requests
-import pyperclip
-import base64
+#   dateutil, pyperclip, and the worker pools are imported where they are used,
+#   so that runs which exit early start quickly
+import http_client
+import metrics
+import timing
 import html
-import random
-
-#	Date manipulation
-from datetime import datetime
-from dateutil import parser
 
 #	Formatting
 import locale
-locale.setlocale(locale.LC_ALL, '')
-
-#   Command line options
-arguments = argparse.ArgumentParser(
-	prog='tweet2html',
-	description='Convert a Tweet ID to semantic HTML')
-arguments.add_argument("id", type=int,                        help="ID of the Tweet (integer)")
-arguments.add_argument("-t", "--thread", action="store_true", help="Show the thread (default false)", required=False)
-arguments.add_argument("-c", "--css",    action="store_true", help="Copy the CSS (default false)",    required=False)
-arguments.add_argument("-p", "--pretty", action="store_true", help="Pretty Print the output (default false)",    required=False)
-arguments.add_argument("-s", "--save",   action="store_true", help="Save the output to a file (default false)",    required=False)
-arguments.add_argument("-m", "--schema", action='store_true', help="Add Schema.org metadata (default false)",    required=False)
-
-args = arguments.parse_args()
-tweet_id = args.id
-
-#	Get settings from arguments
-thread_show  = True if args.thread else False
-css_show     = True if args.css    else False
-pretty_print = True if args.pretty else False
-save_file    = True if args.save   else False
-schema_org   = True if args.schema else False
-
-def image_to_inline( url ) : 
-	#	Download the image
-	image_file = requests.get( url )
-	#	Convert to bytes
-	image_file = Image.open( io.BytesIO( image_file.content ) )
-	#	Temp file name with only alphanumeric characters
-	temp_file_name = "".join(x for x in url if x.isalnum())
-	#	Full path of the image
-	output_img = os.path.join( tempfile.gettempdir() , f"{temp_file_name}.webp" )
-	#	Save as a low quality WebP
-	image_file.save( output_img, 'webp', optimize=True, quality=60 )
-	#   Convert image to base64 data URl
-	#	Read the image from disk
-	binary_img      = open( output_img, 'rb' ).read()
-	#	Encode to Base64
-	base64_utf8_str = base64.b64encode( binary_img ).decode('utf-8')
-	#	Delete the temporary file
-	os.remove( output_img )
-	#	Return as data encoded suitable for an <img src="...">
-	return f'data:image/webp;base64,{base64_utf8_str}'
+
+#   Save directory
+output_directory = "output"
+
+#	Options for render_tweet
+default_options = {
+	"thread": False,	#	Show the parent and quoted Tweets
+	"depth":  1,		#	Most Tweets to show above this one when showing the thread
+	"css":    False,	#	Add the CSS to the output
+	"pretty": False,	#	Pretty print the output
+	"schema": False,	#	Add Schema.org metadata
+}
+
+def tweet_options( options=None ) :
+	#	Fill in any options which weren't given
+	merged = dict( default_options )
+	if options is not None :
+		merged.update( options )
+	return merged
 
 def tweet_entities_to_html(text, entities):
 	#	Initialize a list to hold parts of the HTML output
@@ -149,12 +128,11 @@ def tweet_entities_to_html(text, entities):
 
 def get_media( mediaDetails) :
 	media_html = '<div class="social-embed-media-grid">'
+	#	Convert small version of all the media to embedded images at once
+	print( f"Embedding {len(mediaDetails)} media…" )
+	media_imgs = images_to_inline( [ media["media_url_https"] + ":small" for media in mediaDetails ] )
 	#	Iterate through the attached media
-	for media in mediaDetails :
-		#	Convert small version of media to embedded WebP
-		print( "Embedding media…" )
-		media_img = image_to_inline( media["media_url_https"] + ":small" )
-		
+	for media, media_img in zip( mediaDetails, media_imgs ) :
 		#	Find alt text
 		media_alt = ""
 		if "ext_alt_text" in media :
@@ -271,7 +249,7 @@ def get_card_html( card_data ) :
 			print( "Converting card's thumbnail_image…" )
 			card_thumbnail = card_data["binding_values"]["thumbnail_image"]["image_value"]["url"]
 			#   Convert  media to embedded WebP
-			card_thumbnail = image_to_inline( card_thumbnail )
+			card_thumbnail = image_to_inline( card_thumbnail, "card" )
 			card_thumbnail_html = f'''
 				<img src="{card_thumbnail}" alt="{card_thumbnail_alt}" class="social-embed-media">
 				'''
@@ -289,17 +267,23 @@ def get_card_html( card_data ) :
 		'''
 		return card_html
 
-def tweet_to_html( tweet_data ) :
+def tweet_to_html( tweet_data, options ) :
+	#	Date manipulation
+	from dateutil import parser
+
+	schema_org = options["schema"]
+
 	#	Show the thread / quote?
 	tweet_parent = ""
 	tweet_quote  = ""
-	if thread_show :
-		if "parent" in tweet_data :
+	if options["thread"] :
+		#	Oldest first
+		for ancestor in tweet_ancestors( tweet_data ) :
 			print( "Parent detected…" )
-			tweet_parent = tweet_to_html( tweet_data["parent"] )
+			tweet_parent += tweet_to_html( ancestor, options )
 		if "quoted_tweet" in tweet_data :
 			print( "Quote detected…" )
-			tweet_quote = tweet_to_html( tweet_data["quoted_tweet"] )
+			tweet_quote = tweet_to_html( tweet_data["quoted_tweet"], options )
 
 	#	Take the data from the API of a single Tweet (which might also be a quote or reply).
 	#	Create a semantic HTML representation
@@ -318,21 +302,21 @@ def tweet_to_html( tweet_data ) :
 	tweet_replies  = (int)(tweet_data.get("conversation_count", 0))#	Might not exist
 	tweet_retweets = (int)(tweet_data.get("retweet_count",      0))#	Might not exist
 	tweet_entities = tweet_data["entities"]
-	global tweet_url
 	tweet_url      = f"https://twitter.com/{tweet_user}/status/{tweet_id}"
 
 	#	User labels
 	if "highlighted_label" in tweet_data["user"] :
 		tweet_label     = html.escape( tweet_data["user"]["highlighted_label"]["description"] )
-		tweet_badge_img = image_to_inline( tweet_data["user"]["highlighted_label"]["badge"]["url"] )
+		tweet_badge_img = image_to_inline( tweet_data["user"]["highlighted_label"]["badge"]["url"], "badge" )
 		print( f"Badge found '{tweet_label}'…")
 		tweet_badge  = f'<br><img src="{tweet_badge_img}" alt="" class="social-embed-badge"> {tweet_label}'
 	else :
 		tweet_badge = ""
 
 	#	Get the datetime
-	tweet_time = parser.parse( tweet_date )
-	tweet_time = tweet_time.strftime('%H:%M - %a %d %B %Y')
+	with timing.span( "date.parse" ) :
+		tweet_time = parser.parse( tweet_date )
+		tweet_time = tweet_time.strftime('%H:%M - %a %d %B %Y')
 
 	#	Is this a reply?
 	if "in_reply_to_screen_name" in tweet_data :
@@ -349,7 +333,8 @@ def tweet_to_html( tweet_data ) :
 		tweet_reply = ""
 
 	#   Embed entities
-	tweet_text = tweet_entities_to_html( tweet_text, tweet_entities )
+	with timing.span( "entities" ) :
+		tweet_text = tweet_entities_to_html( tweet_text, tweet_entities )
 
 	#	Add media
 	tweet_media = ""
@@ -364,9 +349,9 @@ def tweet_to_html( tweet_data ) :
 	#   Newlines to BR
 	tweet_text = tweet_text.replace("\n","<br>")
 
-	#   Convert avatar to embedded WebP
+	#   Convert avatar to an embedded image
 	print( "Storing avatar…")
-	tweet_avatar = image_to_inline( tweet_avatar )
+	tweet_avatar = image_to_inline( tweet_avatar, "avatar" )
 
 	#	Avatar shape
 	if tweet_shape == "Circle" :
@@ -418,28 +403,6 @@ def tweet_to_html( tweet_data ) :
 	'''
 	return tweet_html
 
-#   Get the data from the Twitter embed API
-for _ in range(5):
-	#	Lazy retry strategy
-	try :
-		print( "Downloading data…" )
-		token = random.randint(1,10000)
-		json_url =  f"https://cdn.syndication.twimg.com/tweet-result?id={tweet_id}&lang=en&token={token}"
-		response = requests.get(json_url)
-		data = response.json()
-		break
-	except :
-		print( "Retrying…" )
-		continue
-
-#	If Tweet was deleted, exit.
-if "TweetTombstone" == data["__typename"] :
-	print( "This Post was deleted by the Post author." )
-	raise SystemExit
-
-#	Turn the Tweet into HTML
-tweet_html = tweet_to_html(data)
-
 #   Generate Content to be pasted
 
 #	CSS
@@ -608,32 +571,234 @@ blockquote.social-embed {
 </style>
 '''
 
-#	Add the CSS to the output if requsted
-if css_show :
-	tweet_html = tweet_css + tweet_html
+def render_tweet( tweet_data, options=None ) :
+	#	Turn the Tweet's data into the HTML to be pasted.
+	#	options is a dict with any of the keys in default_options
+	tweet_html = tweet_to_output( tweet_data, options )
+	metrics.renders.inc( kind="tweet" )
+	metrics.output_bytes.observe( len( tweet_html.encode("utf-8") ), kind="tweet" )
+	return tweet_html
+
+def tweet_to_output( tweet_data, options=None ) :
+	#	render_tweet without counting it in the metrics, for when the HTML isn't the output - e.g. tweet2img's page
+	options = tweet_options( options )
+	if options["thread"] and options["depth"] != 1 and "ancestors" not in tweet_data :
+		#	Only the parent comes with the Tweet. Follow the replies further up, or show none at depth 0
+		tweet_data = dict( tweet_data, ancestors=get_ancestors( tweet_data, options["depth"] ) )
+	#	Fetch every image the Tweet needs at once, then turn it into HTML
+	held_urls = prefetch_images( tweet_image_urls( tweet_data, options["thread"] ) )
+	try :
+		with timing.span( "template" ) :
+			tweet_html = tweet_to_html( tweet_data, options )
+	finally :
+		release_images( held_urls )
+	with timing.span( "minify" ) :
+		tweet_html = tweet_html_output( tweet_html, options )
+	return tweet_html
+
+def get_tweet_url( tweet_data ) :
+	return f"https://twitter.com/{tweet_data['user']['screen_name']}/status/{tweet_data['id_str']}"
 
-#   Compact the output if necessary
-if not pretty_print :
-	print( "Compacting…")
-	tweet_html = tweet_html.replace("\n", "")
-	tweet_html = tweet_html.replace("\t", "")
+def tweet_html_output( tweet_html, options ) :
+	#	Add the CSS to the output if requsted
+	if options["css"] :
+		tweet_html = tweet_css + tweet_html
 
-#   Copy to clipboard
-pyperclip.copy( tweet_html )
-#   Print to say we've finished
-print( f"Copied {tweet_id}" )
+	#   Compact the output if necessary
+	if not options["pretty"] :
+		print( "Compacting…")
+		tweet_html = tweet_html.replace("\n", "")
+		tweet_html = tweet_html.replace("\t", "")
+	return tweet_html
 
-if save_file :
+def save_html( tweet_id, tweet_html ) :
 	#	Save HTML
-	#   Save directory
-	output_directory = "output"
 	os.makedirs(output_directory, exist_ok = True)
 	save_location = os.path.join( output_directory, f"{tweet_id}.html" ) 
 	#   Save as HTML file
-	with open( save_location, 'w', encoding="utf-8" ) as html_file:
+	with timing.span( "save" ), open( save_location, 'w', encoding="utf-8" ) as html_file:
 		html_file.write( tweet_html )
 	print( f"Saved to {save_location}" )
-
-#	Submit the Tweet to Archive.org
-print( f"Archiving… {tweet_url}" )
-requests.post( "https://web.archive.org/save/", data={"url": tweet_url, "capture_all":"on"}, timeout=5 )
+	return save_location
+
+def archive_tweet( tweet_url ) :
+	#	Submit the Tweet to Archive.org
+	print( f"Archiving… {tweet_url}" )
+	with timing.span( "archive" ) :
+		try :
+			response = http_client.post( "https://web.archive.org/save/", data={"url": tweet_url, "capture_all":"on"}, timeout=5, retries=0 )
+		except Exception :
+			metrics.archive_submissions.inc( result="failed" )
+			raise
+	metrics.archive_submissions.inc( result="ok" if response.ok else "failed" )
+
+def embed_tweet( tweet_id, options, known=None ) :
+	#	Fetch, render, and save a single Tweet in batch mode.
+	#	known is ID -> data of the Tweets the batch has downloaded, so reply chains can share them.
+	#	Returns "saved", "tombstone", or "failed"
+	try :
+		data = get_tweet( tweet_id )
+		if data is None :
+			return "failed"
+		#	If Tweet was deleted, skip it.
+		if is_tombstone( data ) :
+			metrics.tombstones.inc()
+			print( f"{tweet_id} was deleted by the Post author." )
+			return "tombstone"
+		if known is not None :
+			known[ str( tweet_id ) ] = data
+			if options["thread"] and options["depth"] != 1 :
+				data = dict( data, ancestors=get_ancestors( data, options["depth"], known ) )
+		tweet_html = render_tweet( data, options )
+		save_html( tweet_id, tweet_html )
+	except Exception as error :
+		print( f"Failed {tweet_id} - {error}" )
+		return "failed"
+	#	Archiving is best effort, it doesn't fail the embed
+	try :
+		archive_tweet( get_tweet_url( data ) )
+	except Exception as error :
+		print( f"Archiving {tweet_id} failed - {error}" )
+	return "saved"
+
+def read_tweet_ids( id_file ) :
+	#	One ID per line. Blank lines and # comments are ignored, and lines which aren't IDs are skipped
+	if "-" == id_file :
+		lines = sys.stdin.read().splitlines()
+	else :
+		with open( id_file, 'r', encoding="utf-8" ) as ids:
+			lines = ids.read().splitlines()
+	tweet_ids = []
+	for line_number, line in enumerate( lines, start=1 ) :
+		line = line.strip()
+		if line == "" or line.startswith("#") :
+			continue
+		try :
+			tweet_ids.append( int( line ) )
+		except ValueError :
+			print( f"Skipping line {line_number} of {'stdin' if '-' == id_file else id_file} - {line!r} isn't a Tweet ID" )
+	return tweet_ids
+
+def run_batch( tweet_ids, workers, options ) :
+	from concurrent.futures import ThreadPoolExecutor, as_completed
+	print( f"Batch of {len(tweet_ids)} Tweets with {workers} workers…" )
+	start = time.perf_counter()
+	results = {}
+	known   = {}
+	with ThreadPoolExecutor( max_workers=workers ) as executor :
+		futures = { executor.submit( embed_tweet, batch_id, options, known ): batch_id for batch_id in tweet_ids }
+		for future in as_completed( futures ) :
+			results[ futures[future] ] = future.result()
+	elapsed = time.perf_counter() - start
+
+	#	Summary
+	saved      = [ batch_id for batch_id in tweet_ids if results[batch_id] == "saved" ]
+	tombstones = [ batch_id for batch_id in tweet_ids if results[batch_id] == "tombstone" ]
+	failures   = [ batch_id for batch_id in tweet_ids if results[batch_id] == "failed" ]
+	print( f"Saved: {len(saved)}" )
+	print( f"Deleted: {len(tombstones)}" )
+	for batch_id in tombstones :
+		print( f"\t{batch_id}" )
+	print( f"Failed: {len(failures)}" )
+	for batch_id in failures :
+		print( f"\t{batch_id}" )
+	print( f"{len(tweet_ids)} Tweets in {elapsed:.2f}s - {len(tweet_ids) / elapsed:.2f} Tweets per second" )
+	print( image_cache.summary() )
+	if asset_store.enabled :
+		print( asset_store.summary() )
+	print( http_client.summary() )
+	image_cache.save_stats()
+
+def main() :
+	#   Command line options
+	arguments = argparse.ArgumentParser(
+		prog='tweet2html',
+		description='Convert a Tweet ID to semantic HTML')
+	arguments.add_argument("id", type=int, nargs="*",             help="ID of the Tweet (integer). More than one ID runs in batch mode")
+	arguments.add_argument("-t", "--thread", action="store_true", help="Show the thread (default false)", required=False)
+	arguments.add_argument("-d", "--depth",  type=int, default=default_options["depth"], help=f"Follow the thread up this many replies, 0 for none (default {default_options['depth']}, the parent)", required=False)
+	arguments.add_argument("-c", "--css",    action="store_true", help="Copy the CSS (default false)",    required=False)
+	arguments.add_argument("-p", "--pretty", action="store_true", help="Pretty Print the output (default false)",    required=False)
+	arguments.add_argument("-s", "--save",   action="store_true", help="Save the output to a file (default false)",    required=False)
+	arguments.add_argument("-m", "--schema", action='store_true', help="Add Schema.org metadata (default false)",    required=False)
+	arguments.add_argument("-f", "--file",   type=str,            help="File of Tweet IDs, one per line, or - for stdin. Runs in batch mode", required=False)
+	arguments.add_argument("-w", "--workers", type=int, default=8, help="Number of Tweets to process at once in batch mode (default 8)", required=False)
+	timing.add_profile_arguments( arguments )
+	metrics.add_metrics_arguments( arguments )
+	add_assets_arguments( arguments )
+
+	args = arguments.parse_args()
+	with timing.profile( "tweet2html", args.profile, args.cprofile ), metrics.textfile( args.metrics ) :
+		run( arguments, args )
+
+def run( arguments, args ) :
+	#	Everything main() does once the arguments have been read
+
+	#	Number formatting follows the user's locale
+	locale.setlocale(locale.LC_ALL, '')
+
+	#	Get settings from arguments
+	options = tweet_options( {
+		"thread": args.thread,
+		"depth":  args.depth,
+		"css":    args.css,
+		"pretty": args.pretty,
+		"schema": args.schema,
+	} )
+	save_file = True if args.save else False
+
+	#	Get the IDs from arguments, a file, or stdin
+	tweet_ids = list( args.id )
+	if args.file is not None :
+		tweet_ids += read_tweet_ids( args.file )
+	#	Remove duplicates, keeping the order
+	tweet_ids = list( dict.fromkeys( tweet_ids ) )
+	if len( tweet_ids ) == 0 :
+		arguments.error( "at least one Tweet ID is required" )
+	batch_mode = len( tweet_ids ) > 1 or args.file is not None
+	tweet_id   = tweet_ids[0]
+
+	#	Link to image files instead of inlining them? Saved HTML links to them from the output directory
+	saved_to = output_directory if batch_mode or save_file else None
+	asset_store.configure( args.assets_dir, args.assets_url, relative_to=saved_to )
+
+	#	Batch mode if there's more than one ID
+	if batch_mode :
+		run_batch( tweet_ids, args.workers, options )
+		return
+
+	data = get_tweet( tweet_id )
+
+	if data is None :
+		print( "Couldn't download the Tweet." )
+		raise SystemExit
+
+	#	If Tweet was deleted, exit.
+	if is_tombstone( data ) :
+		metrics.tombstones.inc()
+		print( "This Post was deleted by the Post author." )
+		raise SystemExit
+
+	#	Turn the Tweet into HTML
+	tweet_html = render_tweet( data, options )
+	tweet_url  = get_tweet_url( data )
+
+	#   Copy to clipboard
+	import pyperclip
+	with timing.span( "clipboard" ) :
+		pyperclip.copy( tweet_html )
+	#   Print to say we've finished
+	print( f"Copied {tweet_id}" )
+	print( image_cache.summary() )
+	if asset_store.enabled :
+		print( asset_store.summary() )
+	print( http_client.summary() )
+	image_cache.save_stats()
+
+	if save_file :
+		save_html( tweet_id, tweet_html )
+
+	archive_tweet( tweet_url )
+
+if __name__ == "__main__" :
+	main()
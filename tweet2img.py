@@ -5,178 +5,302 @@ import argparse
 import time
 
 #   File and Bits
-import io
 import os
+import pathlib
 import tempfile
 
-#   Image Manipulation
-from PIL import Image
-
-#   Selenium
-from selenium import webdriver 
-from selenium.webdriver.common.keys import Keys
-from selenium.webdriver.common.by import By
-
-#   Firefox specific
-from selenium.webdriver.firefox.options import Options
-from selenium.webdriver.firefox.service import Service
-from webdriver_manager.firefox import GeckoDriverManager
+#   Concurrency
+from concurrent.futures import ThreadPoolExecutor
 
 #   Etc
-import requests
-import pyperclip
+from syndication import get_tweet, is_tombstone
+from browser_pool import BrowserPool
+from screenshot_image import process_screenshot, min_psnr
+from image_assets import asset_store
+import metrics
+import timing
 import base64
 import html
 
-#   If using Chrome
-# from selenium.webdriver.chrome.options import Options
-
-#   Command line options
-parser = argparse.ArgumentParser(
-    prog='tweet2img',
-    description='Convert a Tweet ID to an image and alt text')
-parser.add_argument('id',       type=int,            help='ID of the Tweet (integer)')
-parser.add_argument('--thread', action='store_true', help='Show the thread (default false)', required=False)
-
-args = parser.parse_args()
-tweet_id = args.id
-thread = args.thread
-
-if ( True == thread ):
-    hide_thread = "false"
-else :
-    hide_thread = "true"
-
-# #   Chrome's Headless Options
-# chrome_options = Options()
-# chrome_options.add_argument('--headless=new')
-# chrome_options.add_argument('--window-size=1920,2160')
-
-# #   Turn off everything
-# chrome_options.add_argument("--no-sandbox")
-# chrome_options.add_argument("--disable-dev-shm-usage")
-# chrome_options.add_argument("--disable-extensions")
-# chrome_options.add_argument("--disable-infobars")
-# chrome_options.add_argument("--disable-logging")
-# chrome_options.add_argument("--log-level=3")
-# chrome_options.add_argument('--force-device-scale-factor=1')
-# chrome_options.add_argument('--high-dpi-support=1')
-
-# #   Wayland to stop fuzzyness on fractional scaling
-# chrome_options.add_argument("--enable-features=UseOzonePlatform")
-# chrome_options.add_argument("--ozone-platform=wayland")
-
-# #   Start Chrome
-# driver = webdriver.Chrome(options=chrome_options)
-
-#   Firefox's Headless Options
-firefox_options = Options()
-firefox_options.add_argument("--headless")
-#   Start Firefox
-driver = webdriver.Firefox( options=firefox_options )
-
-#   Open the Tweet on the embed platform
-driver.get(f"https://platform.twitter.com/embed/Tweet.html?hideCard=false&hideThread={hide_thread}&lang=en&theme=light&width=550px&id={tweet_id}")
-
-#   Wait for page to fully render
-time.sleep(3)
-
-#   Get the Tweet
-tweet = driver.find_element(By.TAG_NAME, "article")
-#   Use the parent element for more padding
-tweet = driver.execute_script("return arguments[0].parentNode;", tweet)
-
-#   Get Screenshot
-image_binary = tweet.screenshot_as_png
-img = Image.open(io.BytesIO(image_binary))
-width  = img.width
-height = img.height
-
-#   Resize to a maximum width (useful if on HiDPI screen)
-max_width = 550
-resize_factor = width // max_width
-(width, height) = ( int(img.width // resize_factor), int(img.height // resize_factor))
-img = img.resize( (width, height), Image.Resampling.LANCZOS )
+#   Slow imports (PIL, Selenium, pyperclip, and tweet2html) are in the functions which use them, so --help is quick
 
 #   Save directory
 output_directory = "output"
-os.makedirs(output_directory, exist_ok = True)
-
-#   Optimal(ish) quality
-output_img = os.path.join(output_directory, f"{tweet_id}.webp")
-img.save( output_img, 'webp', optimize=True, quality=60 )
-
-#   Kill the driver
-driver.quit()
-
-#   Generate Alt Text
-tweet_alt  = ""
-ptweet_alt = ""
-qtweet_alt = ""
-
-#   Get the data
-json_url =  f"https://cdn.syndication.twimg.com/tweet-result?id={tweet_id}&lang=en&token=1"
-response = requests.get(json_url)
-data = response.json()
-
-#   Is this a thread?
-if ( "parent" in data and hide_thread == "false" ) :
-    ptweet_text = data["parent"]["text"]
-    ptweet_name = data["parent"]["user"]["name"] + " (@" + data["parent"]["user"]["screen_name"] + ")"
-    ptweet_date = data["parent"]["created_at"]
-    if "mediaDetails" in data["parent"]:
-        for media in data["parent"]["mediaDetails"] :
-            if "ext_alt_text" in media :
-                ptweet_text += " . Image: " + media["ext_alt_text"]
-    ptweet_alt += f"{ptweet_date}. {ptweet_name}. {ptweet_text}. Reply "
-
-#   Text of Tweet
-tweet_text = data["text"]
-tweet_name = data["user"]["name"] + " (@" + data["user"]["screen_name"] + ")"
-tweet_date = data["created_at"] 
-if "mediaDetails" in data:
-    for media in data["mediaDetails"] :
-        if "ext_alt_text" in media :
-            tweet_text += " . Image: " + media["ext_alt_text"]
-tweet_alt += f"{tweet_date}. {tweet_name}. {tweet_text}."
-
-
-#   Is this a quote Tweet?
-if ( "quoted_tweet" in data and hide_thread == "false" ) :
-    qtweet_text = data["quoted_tweet"]["text"]
-    qtweet_name = data["quoted_tweet"]["user"]["name"] + " (@" + data["quoted_tweet"]["user"]["screen_name"] + ")"
-    qtweet_date = data["quoted_tweet"]["created_at"]
-    if "mediaDetails" in data["quoted_tweet"]:
-        for media in data["quoted_tweet"]["mediaDetails"] :
-            if "ext_alt_text" in media :
-                qtweet_text += " . Image: " + media["ext_alt_text"]
-    qtweet_alt += f" Quoting: {qtweet_date}. {qtweet_name}. {qtweet_text}."
-
-#   Stick it all together
-tweet_alt = f"Screenshot from Twitter. {ptweet_alt}{tweet_alt}{qtweet_alt}".replace("\n", " ")
-
-#   Save as a text file
-with open(  os.path.join( output_directory, f"{tweet_id}.txt" ) , 'w', encoding="utf-8" ) as text_file:
-    text_file.write( tweet_alt )
-
-#   Generate HTML to be pasted
 
-#   Link
-tweet_url = "https://twitter.com/" + data["user"]["screen_name"] + "/status/" + data["id_str"]
-
-#   Convert image to base64 data URl
-binary_img      = open(output_img, 'rb').read()
-base64_utf8_str = base64.b64encode(binary_img).decode('utf-8')
-data_url = f'data:image/webp;base64,{base64_utf8_str}'
-
-#   Ensure alt is sanitised
-tweet_alt = html.escape(tweet_alt)
-
-#   HTML to be pasted
-tweet_html = f"<a href=\"{tweet_url}\"><img src=\"{data_url}\" width=\"{width}\" height=\"{height}\" alt=\"{tweet_alt}\"/></a>"
-
-#   Copy to clipboard
-pyperclip.copy( tweet_html )
-
-#   Print to say we've finished
-print( f"Copied {tweet_url}" )
\ No newline at end of file
+#   How long each screenshot took, in seconds
+capture_times = []
+
+#   Gets the Tweet's data and alt text while the browser is busy
+details_pool = ThreadPoolExecutor( max_workers=8 )
+
+#   Whether the element's images and fonts have loaded, and its current size
+ready_script = """
+const element = arguments[0];
+const images  = Array.from( element.querySelectorAll( "img" ) );
+const loaded  = images.every( image => image.complete ) && document.fonts.status === "loaded";
+const rect    = element.getBoundingClientRect();
+return [ loaded, rect.width + "x" + rect.height ];
+"""
+
+#   Page for Tweets rendered by tweet2html. The wrapper is captured, so it is exactly as wide as the embed
+local_page = """<!DOCTYPE html>
+<html lang="en">
+<head><meta charset="utf-8"><title>{tweet_id}</title></head>
+<body style="margin:0;background:#fff"><div style="width:550px">{tweet_html}</div></body>
+</html>
+"""
+
+def wait_until_ready( driver, max_wait, selector="article" ) :
+    #   Returns the element to screenshot once it has rendered, or when max_wait seconds have passed
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.support.ui import WebDriverWait
+
+    deadline = time.monotonic() + max_wait
+
+    #   Wait for the Tweet to exist
+    tweet = WebDriverWait( driver, max_wait, poll_frequency=0.05 ).until( lambda driver: driver.find_element(By.CSS_SELECTOR, selector) )
+    #   Use the parent element for more padding
+    tweet = driver.execute_script("return arguments[0].parentNode;", tweet)
+
+    #   Wait for the images to decode and the layout to stop changing
+    previous_size = None
+    while time.monotonic() < deadline :
+        loaded, size = driver.execute_script( ready_script, tweet )
+        if loaded and size == previous_size :
+            return tweet
+        previous_size = size
+        time.sleep( 0.1 )
+    print( f"Not ready after {max_wait}s, capturing anyway…" )
+    return tweet
+
+def embed_url( tweet_id, hide_thread ) :
+    #   The Tweet on the embed platform
+    return f"https://platform.twitter.com/embed/Tweet.html?hideCard=false&hideThread={hide_thread}&lang=en&theme=light&width=550px&id={tweet_id}"
+
+def write_local_page( tweet_id, data, hide_thread ) :
+    #   Render the Tweet with tweet2html, with its CSS and inlined images, into a temporary file.
+    #   Returns the file's path. Nothing is loaded from Twitter when it is opened
+    from tweet2html import tweet_to_output
+
+    with timing.span( "local.render" ) :
+        tweet_html = tweet_to_output( data, { "thread": hide_thread == "false", "css": True } )
+        page_file, page_path = tempfile.mkstemp( prefix=f"tweet2img-{tweet_id}-", suffix=".html" )
+        with os.fdopen( page_file, 'w', encoding="utf-8" ) as html_file:
+            html_file.write( local_page.format( tweet_id=tweet_id, tweet_html=tweet_html ) )
+    return page_path
+
+def screenshot_tweet( driver, tweet_id, url, max_wait, selector="article" ) :
+    #   Returns ( PNG bytes, the browser's device pixel ratio )
+    start = time.perf_counter()
+
+    #   Open the Tweet
+    with timing.span( "screenshot.load" ) :
+        driver.get( url )
+
+    #   Wait for page to fully render
+    with timing.span( "screenshot.wait" ) :
+        tweet = wait_until_ready( driver, max_wait, selector )
+
+    #   Get Screenshot
+    with timing.span( "screenshot.capture" ) :
+        image_binary = tweet.screenshot_as_png
+        pixel_ratio  = driver.execute_script( "return window.devicePixelRatio;" ) or 1
+    capture_time = time.perf_counter() - start
+    capture_times.append( capture_time )
+    print( f"Captured {tweet_id} in {capture_time:.2f}s" )
+    return ( image_binary, pixel_ratio )
+
+def capture_summary() :
+    #   Distribution of the screenshot times
+    times = sorted( capture_times )
+    if len( times ) == 0 :
+        return "No screenshots taken"
+    median = times[ len( times ) // 2 ]
+    p90    = times[ min( len( times ) - 1, int( len( times ) * 0.9 ) ) ]
+    return f"Captured {len(times)} in min {times[0]:.2f}s, median {median:.2f}s, p90 {p90:.2f}s, max {times[-1]:.2f}s"
+
+def save_screenshot( tweet_id, image_binary, pixel_ratio, min_psnr ) :
+    #   Scale to CSS pixels (useful if on HiDPI screen), trim the border, and pick the smallest WebP
+    with timing.span( "postprocess" ) :
+        ( binary_img, width, height, encoding ) = process_screenshot( image_binary, pixel_ratio=pixel_ratio, threshold=min_psnr )
+
+    #   Save directory
+    os.makedirs(output_directory, exist_ok = True)
+
+    with timing.span( "save" ), open( os.path.join(output_directory, f"{tweet_id}.webp"), 'wb' ) as image_file:
+        image_file.write( binary_img )
+    print( f"Saved {tweet_id} as {encoding} WebP, {len(binary_img):n} bytes" )
+    #   The encoded image is also used for the data URl
+    return ( binary_img, width, height )
+
+def tweet_alt_text( data, hide_thread ) :
+    #   Generate Alt Text
+    tweet_alt  = ""
+    ptweet_alt = ""
+    qtweet_alt = ""
+
+    #   Is this a thread?
+    if ( "parent" in data and hide_thread == "false" ) :
+        ptweet_text = data["parent"]["text"]
+        ptweet_name = data["parent"]["user"]["name"] + " (@" + data["parent"]["user"]["screen_name"] + ")"
+        ptweet_date = data["parent"]["created_at"]
+        if "mediaDetails" in data["parent"]:
+            for media in data["parent"]["mediaDetails"] :
+                if "ext_alt_text" in media :
+                    ptweet_text += " . Image: " + media["ext_alt_text"]
+        ptweet_alt += f"{ptweet_date}. {ptweet_name}. {ptweet_text}. Reply "
+
+    #   Text of Tweet
+    tweet_text = data["text"]
+    tweet_name = data["user"]["name"] + " (@" + data["user"]["screen_name"] + ")"
+    tweet_date = data["created_at"]
+    if "mediaDetails" in data:
+        for media in data["mediaDetails"] :
+            if "ext_alt_text" in media :
+                tweet_text += " . Image: " + media["ext_alt_text"]
+    tweet_alt += f"{tweet_date}. {tweet_name}. {tweet_text}."
+
+    #   Is this a quote Tweet?
+    if ( "quoted_tweet" in data and hide_thread == "false" ) :
+        qtweet_text = data["quoted_tweet"]["text"]
+        qtweet_name = data["quoted_tweet"]["user"]["name"] + " (@" + data["quoted_tweet"]["user"]["screen_name"] + ")"
+        qtweet_date = data["quoted_tweet"]["created_at"]
+        if "mediaDetails" in data["quoted_tweet"]:
+            for media in data["quoted_tweet"]["mediaDetails"] :
+                if "ext_alt_text" in media :
+                    qtweet_text += " . Image: " + media["ext_alt_text"]
+        qtweet_alt += f" Quoting: {qtweet_date}. {qtweet_name}. {qtweet_text}."
+
+    #   Stick it all together
+    return f"Screenshot from Twitter. {ptweet_alt}{tweet_alt}{qtweet_alt}".replace("\n", " ")
+
+def tweet_details( tweet_id, hide_thread, data=None ) :
+    #   Returns ( link, alt text ), or None if the Tweet couldn't be downloaded
+
+    #   Get the data, from the cache if possible
+    if data is None :
+        data = get_tweet( tweet_id )
+
+    if data is None :
+        print( "Couldn't download the Tweet for the alt text." )
+        return None
+
+    with timing.span( "alt_text" ) :
+        tweet_alt = tweet_alt_text( data, hide_thread )
+
+    #   Save as a text file
+    os.makedirs(output_directory, exist_ok = True)
+    with timing.span( "save" ), open(  os.path.join( output_directory, f"{tweet_id}.txt" ) , 'w', encoding="utf-8" ) as text_file:
+        text_file.write( tweet_alt )
+
+    #   Link
+    tweet_url = "https://twitter.com/" + data["user"]["screen_name"] + "/status/" + data["id_str"]
+    return ( tweet_url, tweet_alt )
+
+def tweet_to_img( tweet_id, hide_thread, browsers, max_wait, min_psnr=min_psnr, local=False ) :
+    #   Screenshot a Tweet with a browser from the pool, and return the HTML to be pasted
+
+    if local :
+        #   Render the Tweet here, so the data is needed first
+        data = get_tweet( tweet_id )
+        if data is None or is_tombstone( data ) :
+            print( f"Couldn't render {tweet_id} locally." )
+            return None
+        details   = details_pool.submit( tweet_details, tweet_id, hide_thread, data )
+        page_path = write_local_page( tweet_id, data, hide_thread )
+        try :
+            with browsers.browser() as driver :
+                ( image_binary, pixel_ratio ) = screenshot_tweet( driver, tweet_id, pathlib.Path( page_path ).as_uri(), max_wait, selector="blockquote.social-embed" )
+        finally :
+            os.remove( page_path )
+    else :
+        #   The data and alt text are fetched while the browser renders
+        details = details_pool.submit( tweet_details, tweet_id, hide_thread )
+        with browsers.browser() as driver :
+            ( image_binary, pixel_ratio ) = screenshot_tweet( driver, tweet_id, embed_url( tweet_id, hide_thread ), max_wait )
+    ( binary_img, width, height ) = save_screenshot( tweet_id, image_binary, pixel_ratio, min_psnr )
+
+    if details.result() is None :
+        return None
+    ( tweet_url, tweet_alt ) = details.result()
+
+    #   Generate HTML to be pasted
+
+    #   Convert image to base64 data URl
+    with timing.span( "base64" ) :
+        base64_utf8_str = base64.b64encode(binary_img).decode('utf-8')
+        data_url = f'data:image/webp;base64,{base64_utf8_str}'
+        timing.add_inlined( len( data_url ) )
+
+    #   Ensure alt is sanitised
+    tweet_alt = html.escape(tweet_alt)
+
+    #   HTML to be pasted
+    print( f"Done {tweet_url}" )
+    tweet_html = f"<a href=\"{tweet_url}\"><img src=\"{data_url}\" width=\"{width}\" height=\"{height}\" alt=\"{tweet_alt}\"/></a>"
+    metrics.renders.inc( kind="screenshot" )
+    metrics.output_bytes.observe( len( tweet_html.encode("utf-8") ), kind="screenshot" )
+    return tweet_html
+
+def main() :
+    #   Command line options
+    parser = argparse.ArgumentParser(
+        prog='tweet2img',
+        description='Convert a Tweet ID to an image and alt text')
+    parser.add_argument('id',           type=int, nargs='+', help='ID of the Tweet (integer). Several can be given')
+    parser.add_argument('--thread',     action='store_true', help='Show the thread (default false)', required=False)
+    parser.add_argument('--browsers',   type=int, default=1, help='Number of browsers taking screenshots at once (default 1)', required=False)
+    parser.add_argument('--max-uses',   type=int, default=50, help='Restart a browser after this many screenshots (default 50)', required=False)
+    parser.add_argument('--max-memory', type=int, default=1024, help='Restart a browser using more than this many MB (default 1024)', required=False)
+    parser.add_argument('--max-wait',   type=float, default=10, help='Longest time to wait for a Tweet to render, in seconds (default 10)', required=False)
+    parser.add_argument('--local',      action='store_true', help='Screenshot the Tweet as rendered by tweet2html, rather than loading it from Twitter', required=False)
+    parser.add_argument('--min-psnr',   type=float, default=min_psnr, help=f'Only use a lossy image if it is this close to the screenshot, in dB (default {min_psnr})', required=False)
+    timing.add_profile_arguments( parser )
+    metrics.add_metrics_arguments( parser )
+
+    args = parser.parse_args()
+    with timing.profile( "tweet2img", args.profile, args.cprofile ), metrics.textfile( args.metrics ) :
+        run( args )
+
+def run( args ) :
+    #   Everything main() does once the arguments have been read
+    tweet_ids = list( dict.fromkeys( args.id ) )
+    thread = args.thread
+
+    if ( True == thread ):
+        hide_thread = "false"
+    else :
+        hide_thread = "true"
+
+    #   The local page is opened from a temporary file, so its images must be inlined
+    asset_store.configure( None )
+
+    browsers = BrowserPool( size=args.browsers, max_uses=args.max_uses, max_memory=args.max_memory )
+    try :
+        with ThreadPoolExecutor( max_workers=args.browsers ) as executor :
+            futures = [ executor.submit( tweet_to_img, tweet_id, hide_thread, browsers, args.max_wait, args.min_psnr, args.local ) for tweet_id in tweet_ids ]
+            results = []
+            for tweet_id, future in zip( tweet_ids, futures ) :
+                try :
+                    results.append( future.result() )
+                except Exception as error :
+                    print( f"Failed {tweet_id} - {error}" )
+                    results.append( None )
+    finally :
+        #   Kill the drivers
+        browsers.close()
+    print( capture_summary() )
+
+    #   Copy to clipboard, in the order the IDs were given
+    tweet_html = "\n".join( result for result in results if result is not None )
+    if tweet_html == "" :
+        raise SystemExit
+    import pyperclip
+    with timing.span( "clipboard" ) :
+        pyperclip.copy( tweet_html )
+
+    #   Print to say we've finished
+    print( f"Copied {len(tweet_html.splitlines())} of {len(tweet_ids)} Tweets" )
+
+if __name__ == "__main__" :
+    main()